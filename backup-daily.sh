@@ -3,3 +3,8 @@
 cd /etc/actimetre
 cp history/Actim*.hist daily
 cp *.data daily
+rm -f daily/*.journal
+cp *.journal daily 2>/dev/null
+if [ -f acticentral.db ]; then
+    python3 -c "import sqlite3; sqlite3.connect('acticentral.db').backup(sqlite3.connect('daily/acticentral.db'))"
+fi
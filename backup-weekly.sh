@@ -3,3 +3,6 @@
 cd /etc/actimetre
 cp daily/Actim*.hist weekly
 cp daily/*.data weekly
+rm -f weekly/*.journal
+cp daily/*.journal weekly 2>/dev/null
+cp daily/acticentral.db weekly 2>/dev/null
@@ -1,41 +1,56 @@
 #!/usr/bin/python3
 
-import sys, fcntl
+import io, sys, fcntl, threading
+from contextlib import contextmanager
 from json import JSONDecodeError
 
 from const import *
-
-lock = open(LOCK_FILE, "w+")
-fcntl.lockf(lock, fcntl.LOCK_EX)
-printLog("===================================================")
-
-from registry import Registry
-import actimetre
-import actiserver
-import project
-
-Actimetres = actimetre.initActimetres()
-Actiservers = actiserver.initActiservers()
-Projects = project.initProjects()
+from locks import StateLock, Locks
+import resident, feed
+
+READ_ACTIONS = ('registry', 'projects')
+DUMPS = {'registry': REGISTRY_DUMP, 'projects': PROJECTS_DUMP}
+
+class Request(threading.local):
+    action = ''
+    args: dict[str, list[str]] = {}
+    secret = "YouDontKnowThis"
+    gzipOk = False      # the client takes gzip replies
+    gzipBody = False    # the client gzipped what it posted
+    ifNoneMatch = ''
+
+request = Request()
+renderNow = False   # a request since the last flush needs its HTML written
+
+def lockState(shared=False):
+    lock = open(LOCK_FILE, "w+")
+    fcntl.lockf(lock, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+    return lock
+
+def loadState(everything=False):
+    # Otherwise each collection is only read when the action first touches it
+    global Registry, Actimetres, Actiservers, Projects
+    from registry import Registry
+    import actimetre, actiserver, project
+    if everything:
+        Actimetres = actimetre.initActimetres()
+        Actiservers = actiserver.initActiservers()
+        Projects = project.initProjects()
+    else:
+        Actimetres = actimetre.Actimetres
+        Actiservers = actiserver.Actiservers
+        Projects = project.Projects
 
 def htmlIndex():
     allPages = []
     allServers = ""
     for serverId in Actiservers.listIds():
-        allPages.append('{' +
-                        f'id: "Actis{serverId:03d}", ' +
-                        f'ref: "/actiserver/server{serverId:03d}.html", ' +
-                        f'date: "{JS_TIMEZERO}", ' +
-                        'html: ""}')
+        allPages.append(f'"Actis{serverId:03d}"')
         allServers += f'<tr id="Actis{serverId:03d}"></tr>\n'
     allProjects = ""
     for projectId in Projects.listIds():
         if projectId != 0:
-            allPages.append('{' +
-                         f'id: "Project{projectId:02d}", ' +
-                         f'ref: "/project/project{projectId:02d}.html", ' +
-                         f'date: "{JS_TIMEZERO}", ' +
-                         'html: ""}')
+            allPages.append(f'"Project{projectId:02d}"')
             allProjects += f'<tr id="Project{projectId:02d}"></tr>\n'
     writeTemplateSub(open(INDEX_HTML, "w"), INDEX_TEMPLATE, {
         "{Projects}"   : allProjects,
@@ -43,11 +58,23 @@ def htmlIndex():
         "{allpages}"   : ',\n'.join(allPages),
         "{date}"       : jsDateString(now()),
     })
+    feed.publish(documents=[INDEX_HTML])
 
 def checkAlerts():
     Actimetres.checkAlerts()
     Actiservers.checkAlerts()
 
+def maintenance():
+    # The consistency passes that requests leave to prepare-stats
+    if not Projects.checkIndex():
+        Projects.index()
+        printLog("Project index rebuilt")
+    Projects.reconcile()
+    Actimetres.checkStale()
+    Actiservers.checkStale()
+    Projects.checkStale()
+    checkAlerts()
+
 class ActisInfo:
     def __init__(self, index, serverId, rssi):
         self.index = index
@@ -68,7 +95,7 @@ def assignActim(data):
         serverId = int(actisInfo['serverId'])
         rssi = int(actisInfo['rssi'])
         actisData = ActisInfo(index, serverId, rssi)
-        printLog(f'[{index:2d}] Actis{serverId:03d} ({actisData.cpuIdle:.1f}%): -{rssi}dB')
+        printLog(f'[{index:2d}] Actis{serverId:03d} ({actisData.cpuIdle:.1f}%): -{rssi}dB', LOG_DEBUG)
         actisList.append(actisData)
         alertText += f"Actis{serverId:03d} ({actisData.cpuIdle:.1f}% idle) at -{rssi}dB\n"
         index += 1
@@ -103,49 +130,70 @@ def assignActim(data):
 
 def processForm(formId):
     if formId.startswith('project-'):
-        Projects.processForm(formId, args)
+        Projects.processForm(formId, request.args)
     elif formId.startswith('actim-'):
-        Actimetres.processForm(formId, args)
+        Actimetres.processForm(formId, request.args)
     elif formId.startswith('server-'):
-        Actiservers.processForm(formId, args)
+        Actiservers.processForm(formId, request.args)
     else:
         print(f"Location:\\{INDEX_NAME}\n\n")
 
 def checkSecret():
-    if secret != SECRET_KEY:
-        printLog(f"Wrong secret {secret} vs. {SECRET_KEY}")
-        print(f"Wrong secret {secret}", file=sys.stdout)
+    if request.secret != SECRET_KEY:
+        printLog(f"Wrong secret {request.secret} vs. {SECRET_KEY}")
+        print(f"Wrong secret {request.secret}", file=sys.stdout)
         print("Status: 401\n\n")
         return False
     return True
 
 def processAction():
+    action, args = request.action, request.args
     printLog(f"Process action {action}")
     if action == 'actiserver' or action == 'actiserver3':
         if not checkSecret(): return
         serverId = int(args['serverId'][0])
-        s = Actiservers.processUpdate(serverId, sys.stdin)
-
-        plain()
-        if action == 'actiserver':
-            print(Registry.dump())
+        try:
+            s = Actiservers.processUpdate(serverId, requestBody())
+        except (OSError, EOFError, UnicodeDecodeError):
+            printLog(f'Actis{serverId:03d} sent a bad gzip body')
+            print("Status: 400\n\n")
+            return
+
+        if s is None:
+            plain('\n?')
+        elif action == 'actiserver':
+            plain('\n' + Registry.dump(), request.gzipOk)
         else:
+            reply = ''
+            if s.seq != 0:
+                reply += f'\n={s.seq}'
             if Registry.needUpdate(s.dbTime) or Projects.needUpdate(s.dbTime):
                 printLog(f'{s.dbTime} needs update')
-                print('!')
+                reply += '\n!'
             for (actimId, command) in Actiservers.getRemotes(serverId):
                 printLog(f'Send Actim{actimId:04d} command 0x{command:02X}')
-                print(f'+{actimId}:{command}')
+                reply += f'\n+{actimId}:{command}'
+            plain(reply, request.gzipOk)
 
     elif action == 'registry':
         if not checkSecret(): return
-#        serverId = int(args['serverId'][0])
-        plain(Registry.dump())
+        if 'serverId' in args.keys():
+            plain(Registry.dumpFor(Actiservers.projection(int(args['serverId'][0]))), request.gzipOk)
+        elif 'since' in args.keys():
+            plain(Registry.since(int(args['since'][0])), request.gzipOk)
+        else:
+            writeDump(REGISTRY_DUMP, Registry.dump())
+            serveDump(REGISTRY_DUMP, request.ifNoneMatch, request.gzipOk)
 
     elif action == 'projects':
         if not checkSecret(): return
-#        serverId = int(args['serverId'][0])
-        plain(Projects.dump())
+        if 'serverId' in args.keys():
+            plain(Projects.dumpFor(Actiservers.projection(int(args['serverId'][0]))), request.gzipOk)
+        elif 'since' in args.keys():
+            plain(Projects.since(int(args['since'][0])), request.gzipOk)
+        else:
+            writeDump(PROJECTS_DUMP, Projects.dump())
+            serveDump(PROJECTS_DUMP, request.ifNoneMatch, request.gzipOk)
 
     elif action == 'actimetre-new':
         if not checkSecret(): return
@@ -200,39 +248,237 @@ def processAction():
 
     else: print("Status: 205\n\n")
 
-def saveAll():
+PENDING_KINDS = ('actim', 'graph', 'server', 'project', 'projectStale', 'page')
+
+def loadPending():
+    pending = {kind: set() for kind in PENDING_KINDS}
+    if os.path.isfile(PENDING_FILE):
+        for kind, ids in loadData(PENDING_FILE).items():
+            pending[kind].update(ids)
+    return pending
+
+def deferSave():
+    # Save the data now, and record what the next saveAll(backlog=True) has to render
+    pending = loadPending()
+    Registry.save()
+    Actimetres.deferSave(pending)
+    Actiservers.deferSave(pending)
+    Projects.deferSave(pending)
+    if any(len(ids) > 0 for ids in pending.values()):
+        dumpData(PENDING_FILE, {kind: sorted(ids) for kind, ids in pending.items()})
+
+def deferGraphs():
+    # Outside of prepare-stats, graphs wait in pending.data for its batch
+    pending = loadPending()
+    if Actimetres.deferGraphs(pending):
+        dumpData(PENDING_FILE, {kind: sorted(ids) for kind, ids in pending.items()})
+
+def saveAll(backlog=False):
+    # Only prepare-stats takes up the pending backlog, a request renders what it changed
+    if backlog and os.path.isfile(PENDING_FILE):
+        pending = loadPending()
+        Actimetres.restore(pending)
+        Actiservers.restore(pending)
+        Projects.restore(pending)
+        os.remove(PENDING_FILE)
+    indexStale = Projects.dirty or Actiservers.dirty
     Registry.save()
     Actimetres.save()
     Actiservers.save()
     Projects.save()
-    if Projects.dirty or Actiservers.dirty or \
-        fileOlderThan(INDEX_HTML, 3600):
+    if indexStale or fileOlderThan(INDEX_HTML, 3600):
         htmlIndex()
-
-import argparse
-cmdparser = argparse.ArgumentParser()
-cmdparser.add_argument('action', default='', nargs='?')
-cmdargs = cmdparser.parse_args()
-if cmdargs.action == 'prepare-stats':
-    printLog("Timer prepare-stats")
-    checkAlerts()
-    saveAll()
-    lock.close()
-    sys.exit(0)
-
-import urllib.parse
-qs = os.environ['QUERY_STRING']
-client = os.environ['REMOTE_ADDR']
-printLog(f"From {client}: {qs}")
-
-args = urllib.parse.parse_qs(qs, keep_blank_values=True)
-if 'action' in args.keys():
-    action = args['action'][0]
-    if 'secret' in args.keys():
-        secret = args['secret'][0]
+    Actimetres.compact()
+    Actiservers.compact()
+
+def requestBody():
+    if request.gzipBody:
+        return io.StringIO(gzip.decompress(sys.stdin.buffer.read()).decode())
+    return sys.stdin
+
+def parseRequest(qs, environ):
+    import urllib.parse
+    request.gzipOk = 'gzip' in environ.get('HTTP_ACCEPT_ENCODING', '')
+    request.gzipBody = environ.get('HTTP_CONTENT_ENCODING', '').strip().lower() == 'gzip'
+    request.ifNoneMatch = environ.get('HTTP_IF_NONE_MATCH', '')
+    request.args = urllib.parse.parse_qs(qs, keep_blank_values=True)
+    if 'action' in request.args.keys():
+        request.action = request.args['action'][0]
     else:
-        secret = "YouDontKnowThis"
-    processAction()
-    saveAll()
-
-lock.close()
+        request.action = ''
+    if 'secret' in request.args.keys():
+        request.secret = request.args['secret'][0]
+    else:
+        request.secret = "YouDontKnowThis"
+
+def isDump():
+    # A whole registry or projects dump, served from what the last save wrote
+    return request.action in DUMPS and 'since' not in request.args.keys() \
+        and 'serverId' not in request.args.keys() and os.path.isfile(DUMPS[request.action])
+
+def isReadOnly():
+    return request.action in READ_ACTIONS
+
+def isDeferred():
+    # Heartbeats and the Actimetre's own reports only touch the Actimetres and Actiservers data
+    action = request.action
+    return RENDER_DEFERRED and (action in ('actiserver', 'actiserver3', 'actimetre-off', 'actim-report', 'actim-clear')
+                                or action.startswith('actim-remote-'))
+
+@contextmanager
+def lockAction():
+    # Heartbeats and single-Actimetre actions only lock their own records
+    action, args = request.action, request.args
+    if isReadOnly() or action == 'actimetre-query':
+        with StateLock.shared():
+            yield
+    elif action in ('actiserver', 'actiserver3') and Actiservers[int(args['serverId'][0])]:
+        with StateLock.shared(), Locks('server', int(args['serverId'][0])):
+            yield
+    elif (action == 'actimetre-off' or action.startswith('actim-')) and action != 'actim-forget' \
+            and Actimetres[int(args['actimId'][0])]:
+        with StateLock.shared(), Locks('actim', int(args['actimId'][0])):
+            yield
+    else:
+        with StateLock.exclusive():
+            yield
+
+def handleRequest(qs, client, environ):
+    global renderNow
+    parseRequest(qs, environ)
+    if request.action == 'feed':
+        # Polled by every open dashboard, needs no state
+        feed.respond(sys.stdin)
+        return False
+    if request.action == 'events':
+        # Only the resident process can stream, the dashboards fall back to the feed
+        print("Status: 204\n\n")
+        return False
+    if isDump():
+        # Needs no state either
+        printLog(f"From {client}: {qs}", LOG_DEBUG)
+        if checkSecret():
+            serveDump(DUMPS[request.action], request.ifNoneMatch, request.gzipOk)
+        return False
+    printLog(f"From {client}: {qs}")
+    if request.action != '':
+        with lockAction():
+            processAction()
+        if Actiservers.loaded():
+            with StateLock.shared():
+                Actiservers.applyMoves()
+        if not isReadOnly() and not isDeferred():
+            renderNow = True
+        return True
+    return False
+
+def flushState():
+    global renderNow
+    with StateLock.exclusive():
+        lock = lockState()
+        if renderNow or not RENDER_DEFERRED:
+            renderNow = False
+            saveAll()
+            deferGraphs()
+        else: deferSave()
+        lock.close()
+
+def tickState():
+    from history import Graphs
+    printLog("Resident prepare-stats")
+    with StateLock.exclusive():
+        maintenance()
+        Graphs.start()
+        lock = lockState()
+        saveAll(backlog=True)
+        Actimetres.drawGraphs()
+        lock.close()
+    Graphs.draw()
+
+def serve():
+    import signal
+    server = resident.ResidentServer(handleRequest, flushState, tickState)
+    lock = lockState()
+    printLog("===================================================")
+    printLog(f"Resident on {RESIDENT_ADDRESS[0]}:{RESIDENT_ADDRESS[1]}")
+    loadState(everything=True)
+    lock.close()
+    with open(PID_FILE, "w") as pid:
+        print(os.getpid(), file=pid)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    finally:
+        setNow()
+        flushState()
+        os.remove(PID_FILE)
+        printLog("Resident stopped")
+
+# actimetre.py imports checkSecret from here, make that find this instance
+sys.modules['acticentral'] = sys.modules[__name__]
+
+def main():
+    import argparse
+    cmdparser = argparse.ArgumentParser()
+    cmdparser.add_argument('action', default='', nargs='?')
+    cmdargs = cmdparser.parse_args()
+    if cmdargs.action == 'serve':
+        serve()
+        sys.exit(0)
+
+    if cmdargs.action == 'import-history':
+        from history import importHistories
+        lock = lockState()
+        importHistories()
+        lock.close()
+        sys.exit(0)
+
+    if cmdargs.action == 'send-mail':
+        from mailer import deliver
+        deliver()
+        sys.exit(0)
+
+    if cmdargs.action == 'migrate-storage':
+        from storage import migrateStores
+        lock = lockState()
+        migrateStores()
+        lock.close()
+        sys.exit(0)
+
+    if cmdargs.action == 'prepare-stats':
+        if resident.isRunning():
+            printLog("Timer prepare-stats: resident process does it")
+            sys.exit(0)
+        lock = lockState()
+        printLog("===================================================")
+        printLog("Timer prepare-stats")
+        loadState(everything=True)
+        from history import Graphs
+        Graphs.start()
+        maintenance()
+        saveAll(backlog=True)
+        Actimetres.drawGraphs()
+        lock.close()
+        Graphs.draw()
+        sys.exit(0)
+
+    qs = os.environ['QUERY_STRING']
+    client = os.environ['REMOTE_ADDR']
+    if not resident.forward(qs, client):
+        parseRequest(qs, os.environ)
+        if request.action in ('feed', 'events') or isDump():
+            handleRequest(qs, client, os.environ)
+            sys.exit(0)
+        lock = lockState(shared=isReadOnly())
+        printLog("===================================================")
+        loadState()
+        if handleRequest(qs, client, os.environ) and not isReadOnly():
+            if isDeferred(): deferSave()
+            else:
+                saveAll()
+                deferGraphs()
+        lock.close()
+
+# The graph pool workers import this file too, only run it as the script
+if __name__ == '__main__':
+    main()
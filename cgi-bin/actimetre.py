@@ -1,11 +1,30 @@
 import sys
 
 from const import *
+from locks import Locks
+from storage import openStore, LazyCollection
+import feed
 from registry import Registry
 from project import Projects
 from actiserver import Actiservers
 
 class Actimetre:
+    # What a delta heartbeat may carry without going through update()
+    DELTA_FIELDS = {'boardType' : str,
+                    'version'   : str,
+                    'sensorStr' : str,
+                    'isStopped' : lambda value: str(value).strip().upper() == "TRUE",
+                    'lastSeen'  : utcStrptime,
+                    'lastReport': utcStrptime,
+                    'rating'    : float,
+                    'rssi'      : int,
+                    'repoNums'  : int,
+                    'repoSize'  : int,
+                    }
+    # What a full heartbeat carries, and a delta for an unknown Actimetre
+    REPORTED = ('actimId', 'mac', 'boardType', 'version', 'isDead', 'isStopped', 'bootTime', 'lastSeen',
+                'lastReport', 'sensorStr', 'frequency', 'rating', 'rssi', 'repoNums', 'repoSize')
+
     def __init__(self, actimId=0, mac='.' * 12, boardType='???', version='000',
                  isDead=5, isStopped=False,
                  bootTime=TIMEZERO, lastSeen=TIMEZERO, lastReport=TIMEZERO,
@@ -29,6 +48,7 @@ class Actimetre:
         self.reportStr  = ""
         self.remote     = 0
         self.dirty      = False
+        self.graphDirty = False
 
     def __str__(self):
         string = f'Actim{self.actimId:04d}'
@@ -110,7 +130,18 @@ class Actimetre:
         self.repoNums   = newActim.repoNums
         self.repoSize   = newActim.repoSize
         self.dirty = True
-        history.drawGraphMaybe()
+        if history.dirty:
+            self.graphDirty = True
+
+    def applyDelta(self, d: dict):
+        # A change of life, boot or frequency goes to the history, the rest is only copied
+        if 'isDead' in d or 'bootTime' in d or 'frequency' in d:
+            self.update(Actimetre().fromD(self.toD() | d | {'actimId': self.actimId}, True))
+            return
+        for field, value in d.items():
+            if field in self.DELTA_FIELDS:
+                setattr(self, field, self.DELTA_FIELDS[field](value))
+        self.dirty = True
 
     def name(self):
         return f"Actim{self.actimId:04d}"
@@ -138,16 +169,13 @@ class Actimetre:
         from history import ActimHistory
         ActimHistory(self).cutHistory()
 
-    def drawGraph(self):
-        from history import ActimHistory
-        ActimHistory(self).drawGraph()
-
     def drawGraphMaybe(self):
         from history import ActimHistory
         return ActimHistory(self).drawGraphMaybe()
 
-    def alert(self, subject=None, info=""):
+    def alert(self, subject=None, info="", level=None):
         printLog(f'Alert {self.name()}')
+        if level is None: level = self.isDead
         if subject is None:
             subject = f'{self.name()} unreachable since {self.lastSeen.strftime(TIMEFORMAT_ALERT)}'
         content = f'{self.name()}\n'
@@ -158,7 +186,7 @@ class Actimetre:
                    f'Total data {self.repoNums} files, size {printSize(self.repoSize)}\n'
         content += Actiservers.serverInfo(self.actimId)
 
-        sendEmail(Projects.getEmail(Projects.getProjectId(self.actimId)), subject, content + info)
+        sendAlert(Projects.getEmail(Projects.getProjectId(self.actimId)), level, subject, content, info)
 
     def forgetData(self):
         self.isDead = 3
@@ -174,7 +202,8 @@ class Actimetre:
         self.frequency = 0
         self.isDead = 1
         from history import ActimHistory
-        ActimHistory(self).addFreqEvent(NOW, 0).drawGraph()
+        ActimHistory(self).addFreqEvent(NOW, 0)
+        self.graphDirty = True
         # serverId = Actiservers.removeActim(self.actimId)
         # printLog(f"Actim{self.actimId:04d} removed from Actis{serverId:03d}")
         # self.repoSize = 0
@@ -274,7 +303,6 @@ class Actimetre:
                                              history.graphSince.strftime(TIMEFORMAT_DISP) +
                                              '&#x2702;' +
                                              f'<span class="{alive}">{self.uptime()}</span>\n'))
-                    history.drawGraphMaybe()
                     with tag('div'):
                         doc.stag('img',
                                  src=f'/images/actim{self.actimId:04d}.svg',
@@ -301,47 +329,74 @@ class Actimetre:
 
     def save(self):
         if self.dirty:
-            printLog(f'Actim{self.actimId:04d}[{Projects.getProjectId(self.actimId)}]({self.isDead}) is dirty')
-            with open(f'{ACTIM_HTML_DIR}/actim{self.actimId:04d}.html', "w") as html:
-                print(self.html(), file=html)
+            printLog(f'Actim{self.actimId:04d}[{Projects.getProjectId(self.actimId)}]({self.isDead}) is dirty', LOG_DEBUG)
+            fragment = self.html()
+            if writeIfChanged(f'{ACTIM_HTML_DIR}/actim{self.actimId:04d}.html', fragment + '\n'):
+                feed.publish(pages={self.name(): fragment})
             self.drawGraphMaybe()
+            self.dirty = False
             return True
         else:
             return False
 
-class ActimetresClass:
+class ActimetresClass(LazyCollection):
+    lazyAttributes = ('actims',)
+
     def __init__(self):
-        self.actims: dict[int, Actimetre] = {}
-        self.dirty = False  # save data
+        self.store = openStore(ACTIMETRES)
         self.stale = False  # write HTML
 
     def __getitem__(self, item: int):
         return item in self.actims
 
     def init(self):
-        self.actims = {int(actimId):Actimetre().fromD(d) for actimId, d in loadData(ACTIMETRES).items()}
+        self.actims: dict[int, Actimetre] = \
+            {int(actimId):Actimetre().fromD(d) for actimId, d in self.store.load().items()}
         for mac, actimId in Registry.macToId.items():
             if actimId not in self.actims.keys():
                 self.actims[actimId] = Actimetre(actimId, mac=mac)
+
+    def checkStale(self):
         for actim in self.actims.values():
             if fileNeedsUpdate(f'{ACTIM_HTML_DIR}/actim{actim.actimId:04d}.html', actim.lastReport):
                 actim.dirty = True
         if fileOlderThan(ACTIMS_HTML, 3600):
             self.stale = True
 
+    def drawGraphs(self):
+        for actim in list(self.actims.values()):
+            actim.drawGraphMaybe()
+
     def str(self, actimId: int):
         if not actimId in self.actims.keys(): return ""
         return str(self.actims[actimId])
 
     def fromDactual(self, data):
         a = Actimetre().fromD(data, True)
-        if a.actimId in self.actims:
-            self.actims[a.actimId].update(a)
-        else:
-            self.actims[a.actimId] = a
-        self.dirty = True
+        with Locks('actim', a.actimId):
+            if a.actimId in self.actims:
+                self.actims[a.actimId].update(a)
+            else:
+                self.actims[a.actimId] = a
         return a.actimId
 
+    def acceptsDelta(self, actimId, data):
+        if actimId not in self.actims:
+            return all(field in data for field in Actimetre.REPORTED)
+        # We declared it dead but its server still sees it: only a full report has its frequency
+        actim = self.actims[actimId]
+        if actim.isDead != 0 and 'isDead' not in data and 'lastSeen' in data and \
+                utcStrptime(data['lastSeen']) > actim.lastSeen:
+            return False
+        return True
+
+    def deltaActual(self, actimId, data):
+        with Locks('actim', actimId):
+            if actimId in self.actims:
+                self.actims[actimId].applyDelta(data)
+            else:
+                self.actims[actimId] = Actimetre().fromD(data, True)
+
     def dump(self, actimId: int):
         return json.dumps(self.actims[actimId].toD())
 
@@ -376,6 +431,7 @@ class ActimetresClass:
         actimId = Registry.getId(mac)
         printLog(f"Actim{actimId:04d} for {mac} is type {boardType} booted at {bootTime}")
         self.actims[actimId] = Actimetre(actimId, mac, boardType, version, 0, bootTime, lastSeen=NOW, lastReport=NOW)
+        self.actims[actimId].dirty = True
         self.stale = True
         return actimId
 
@@ -406,10 +462,10 @@ class ActimetresClass:
                 a.isDead = 3
                 a.dirty = True
 
-    def alertAll(self, actimetreList, subject, content):
+    def alertAll(self, actimetreList, subject, content, level):
         for actimId in actimetreList:
             if actimId in self.actims.keys():
-                self.actims[actimId].alert(subject, content)
+                self.actims[actimId].alert(subject, content, level)
 
     def getName(self, actimId: int):
         if not actimId in self.actims: return ""
@@ -421,11 +477,12 @@ class ActimetresClass:
 
     def getRemote(self, actimId):
         if actimId in self.actims.keys():
-            command = self.actims[actimId].remote
-            if command != 0:
-                self.actims[actimId].remote = 0
-                self.actims[actimId].dirty = True
-                return command
+            with Locks('actim', actimId):
+                command = self.actims[actimId].remote
+                if command != 0:
+                    self.actims[actimId].remote = 0
+                    self.actims[actimId].dirty = True
+                    return command
         return 0
 
     def processAction(self, action, args):
@@ -433,7 +490,7 @@ class ActimetresClass:
 
         if action == 'actim-cut-graph':
             actim.cutHistory()
-            actim.drawGraph()
+            actim.graphDirty = True
             print("Status: 205\n\n")
 
         elif action == 'actim-report':
@@ -536,27 +593,72 @@ class ActimetresClass:
         else:
             print("Status: 205\n\n")
 
+    def snapshot(self):
+        return {int(a.actimId):a.toD() for a in self.actims.values()}
+
+    def saveData(self, changed):
+        if len(changed) > 0:
+            self.store.put({actimId: self.actims[actimId].toD() for actimId in changed}, self.snapshot)
+
+    def compact(self):
+        if not self.loaded(): return
+        self.store.compact(self.snapshot)
+
+    def deferSave(self, pending):
+        # Save the data only, and leave the HTML and graphs to the next save()
+        if not self.loaded(): return
+        changed = set()
+        for actim in self.actims.values():
+            if actim.dirty:
+                pending['actim'].add(actim.actimId)
+                changed.add(actim.actimId)
+            if actim.graphDirty:
+                pending['graph'].add(actim.actimId)
+            actim.dirty = actim.graphDirty = False
+        self.saveData(changed)
+        if self.stale:
+            pending['page'].add('actims')
+        self.stale = False
+
+    def deferGraphs(self, pending):
+        # The graphs save() marked, for the next batch
+        if not self.loaded(): return False
+        deferred = False
+        for actim in self.actims.values():
+            if actim.graphDirty:
+                pending['graph'].add(actim.actimId)
+                actim.graphDirty = False
+                deferred = True
+        return deferred
+
+    def restore(self, pending):
+        for actimId in pending['actim'] & self.actims.keys():
+            self.actims[actimId].dirty = True
+        for actimId in pending['graph'] & self.actims.keys():
+            self.actims[actimId].graphDirty = True
+        if 'actims' in pending['page']:
+            self.stale = True
+
     def save(self):
+        if not self.loaded(): return
+        changed = set()
         for actim in self.actims.values():
             if actim.save():
-                self.dirty = True
-        if self.dirty:
-            dumpData(ACTIMETRES, {int(a.actimId):a.toD() for a in self.actims.values()})
+                changed.add(actim.actimId)
+        self.saveData(changed)
         if self.stale:
             allPages = []
             htmlAll = ""
             for actimId in sorted(self.actims.keys()):
                 htmlAll += f'<tr id="Actim{actimId:04d}"></tr>\n'
-                allPages.append('{' +
-                                f'id: "Actim{actimId:04d}", ' +
-                                f'ref: "/actimetre/actim{actimId:04d}.html", ' +
-                                f'date: "{JS_TIMEZERO}", ' +
-                                'html: ""}')
+                allPages.append(f'"Actim{actimId:04d}"')
             writeTemplateSub(open(ACTIMS_HTML, "w"), ACTIMS_TEMPLATE, {
                 "{Actimetres}": htmlAll,
                 "{allpages}"  : ',\n'.join(allPages),
                 "{date}"      : jsDateString(now()),
             })
+            feed.publish(documents=[ACTIMS_HTML])
+        self.stale = False
 
 Actimetres: ActimetresClass = ActimetresClass()
 def initActimetres() -> ActimetresClass:
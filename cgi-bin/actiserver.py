@@ -1,8 +1,27 @@
+import copy
 from const import *
+from locks import Locks
+from storage import openStore, LazyCollection
+from registry import Registry
+import feed
 import actimetre
 import project
 
 class Actiserver:
+    # What a delta heartbeat may carry about the server itself
+    DELTA_FIELDS = {'machine' : str,
+                    'version' : str,
+                    'channel' : int,
+                    'ip'      : str,
+                    'diskSize': int,
+                    'diskFree': int,
+                    'dbTime'  : utcStrptime,
+                    'cpuIdle' : float,
+                    'memAvail': float,
+                    'diskTput': float,
+                    'diskUtil': float,
+                    }
+
     def __init__(self, serverId=0, machine="Unknown", version="000",
                  channel=0, ip = "0.0.0.0", isDown = 0, lastUpdate=TIMEZERO, dbTime=TIMEZERO,
                  actimetreList=None):
@@ -25,6 +44,7 @@ class Actiserver:
         self.memAvail   = 0.0
         self.diskTput   = 0.0
         self.diskUtil   = 0.0
+        self.seq        = 0
         self.dirty      = False
 
     def __str__(self):
@@ -52,6 +72,7 @@ class Actiserver:
                 'memAvail'  : self.memAvail,
                 'diskTput'  : self.diskTput,
                 'diskUtil'  : self.diskUtil,
+                'seq'       : self.seq,
                 }
 
     def fromD(self, d, actual=False):
@@ -68,6 +89,7 @@ class Actiserver:
         self.memAvail = float(d['memAvail'])
         self.diskTput = float(d['diskTput'])
         self.diskUtil = float(d['diskUtil'])
+        self.seq      = int(d.get('seq', 0))
 
         Actimetres = actimetre.Actimetres
         if d['actimetreList'] != "[]":
@@ -88,6 +110,16 @@ class Actiserver:
         self.dirty = actual
         return self
 
+    def fromDelta(self, d):
+        for field, value in d.items():
+            if field in self.DELTA_FIELDS:
+                setattr(self, field, self.DELTA_FIELDS[field](value))
+        self.seq = int(d['seq'])
+        self.isDown = 0
+        self.lastUpdate = NOW
+        self.dirty = True
+        return self
+
     def name(self):
         return f"Actis{self.serverId:03d}"
 
@@ -96,11 +128,14 @@ class Actiserver:
             self.actimetreList.add(actimId)
             self.lastUpdate = NOW
             self.dirty = True
+        Actiservers.indexActim(actimId, self.serverId)
 
     def removeActim(self, actimId):
         if actimId in self.actimetreList:
-            self.actimetreList.remove(actimId)
+            # Copy, another server's heartbeat may be iterating over this list
+            self.actimetreList = self.actimetreList - {actimId}
             self.dirty = True
+            Actiservers.unindexActim(actimId, self.serverId)
             return True
         else: return False
 
@@ -121,14 +156,14 @@ class Actiserver:
         printLog(f'Alert {self.name()}')
         subject = f'{self.name()} unreachable since {self.lastUpdate.strftime(TIMEFORMAT_ALERT)}'
 #        sendEmail("", subject, self.alertContent())
-        Actimetres.alertAll(self.actimetreList, subject, self.alertContent())
+        Actimetres.alertAll(self.actimetreList, subject, self.alertContent(), self.isDown + 1)
 
     def alertDisk(self):
         Actimetres = actimetre.Actimetres
         printLog(f'{self.name()} disk low')
         subject = f'{self.name()} storage low'
-        sendEmail("", subject, self.alertContent())
-        Actimetres.alertAll(self.actimetreList, subject, self.alertContent())
+        sendAlert("", self.diskLow, subject, self.alertContent())
+        Actimetres.alertAll(self.actimetreList, subject, self.alertContent(), self.diskLow)
 
     def html(self):
         from actimetre import Actimetres
@@ -200,19 +235,84 @@ class Actiserver:
 
     def save(self):
         if self.dirty:
-            printLog(f'Actis{self.serverId:03d} is dirty')
-            with open(f'{SERVER_HTML_DIR}/server{self.serverId:03d}.html', "w") as html:
-                print(self.html(), file=html)
+            printLog(f'Actis{self.serverId:03d} is dirty', LOG_DEBUG)
+            fragment = self.html()
+            if writeIfChanged(f'{SERVER_HTML_DIR}/server{self.serverId:03d}.html', fragment + '\n'):
+                feed.publish(pages={self.name(): fragment})
+            self.dirty = False
             return True
         else: return False
 
-class ActiserversClass:
+class ActiserversClass(LazyCollection):
+    lazyAttributes = ('servers', 'actimToServer', 'unassigned')
+
     def __init__(self):
-        self.servers: dict[int, Actiserver] = {}
+        self.moves: list[tuple[int, int, int]] = []
+        self.guard = threading.Lock()
+        self.store = openStore(ACTISERVERS)
         self.dirty = False
 
     def init(self):
-        self.servers = {int(serverId):Actiserver().fromD(d) for serverId, d in loadData(ACTISERVERS).items()}
+        self.servers: dict[int, Actiserver] = \
+            {int(serverId):Actiserver().fromD(d) for serverId, d in self.store.load().items()}
+        self.reindex()
+
+    def reindex(self):
+        # The most recently heard server wins an Actimetre listed twice
+        self.actimToServer: dict[int, int] = {}
+        self.unassigned: dict[int, None] = {}     # oldest first
+        for server in sorted(self.servers.values(), key=lambda s: s.lastUpdate):
+            for actimId in server.actimetreList:
+                self.indexActim(actimId, server.serverId)
+        self.applyMoves()
+        # In the order saved with the servers, so both modes project the same without the Actimetres
+        free = Registry.idToMac.keys() - self.actimToServer.keys()
+        if os.path.isfile(UNASSIGNED_FILE):
+            saved = [actimId for actimId in loadData(UNASSIGNED_FILE).get('unassigned', []) if actimId in free]
+            unassigned = sorted(free - set(saved)) + saved
+        else:
+            unassigned = sorted(free, key=actimetre.Actimetres.getLastSeen)
+        self.unassigned = dict.fromkeys(unassigned[-UNASSIGNED_KEEP:])
+        self.savedUnassigned = list(self.unassigned)
+
+    def indexActim(self, actimId, serverId):
+        oldServerId = self.actimToServer.get(actimId, 0)
+        if oldServerId != serverId and oldServerId in self.servers:
+            # Only the new server is locked here, applyMoves() takes the old one off
+            with self.guard:
+                self.moves.append((actimId, oldServerId, serverId))
+        self.actimToServer[actimId] = serverId
+        with self.guard:
+            self.unassigned.pop(actimId, None)
+
+    def applyMoves(self):
+        # Once the request has let go of its server, lock both in ID order
+        with self.guard:
+            moves, self.moves = self.moves, []
+        for actimId, oldServerId, serverId in moves:
+            with Locks('server', min(oldServerId, serverId)), Locks('server', max(oldServerId, serverId)):
+                if self.actimToServer.get(actimId) == serverId and oldServerId in self.servers:
+                    printLog(f'Actim{actimId:04d} moved from Actis{oldServerId:03d} to Actis{serverId:03d}')
+                    self.servers[oldServerId].removeActim(actimId)
+
+    def unindexActim(self, actimId, serverId):
+        if self.actimToServer.get(actimId) == serverId:
+            del self.actimToServer[actimId]
+            with self.guard:
+                self.unassigned[actimId] = None
+                while len(self.unassigned) > UNASSIGNED_KEEP:
+                    del self.unassigned[next(iter(self.unassigned))]
+
+    def projection(self, serverId):
+        # What this server may host: its own Actimetres, and the last ones left without a server
+        unassigned = self.unassigned    # loads the servers, outside of the guard
+        with self.guard:
+            actimIds = set(unassigned.keys())
+        if serverId in self.servers:
+            actimIds |= self.servers[serverId].actimetreList
+        return actimIds
+
+    def checkStale(self):
         if fileOlderThan(SERVERS_HTML, 3600):
             self.dirty = True
         for server in self.servers.values():
@@ -227,17 +327,14 @@ class ActiserversClass:
         allServers = ""
         for serverId in sorted(self.servers.keys()):
             if picker is None or picker(self.servers[serverId]):
-                allPages.append('{' +
-                                f'id: "Actis{serverId:03d}", ' +
-                                f'ref: "/actiserver/server{serverId:03d}.html", ' +
-                                f'date: "{JS_TIMEZERO}", ' +
-                                'html: ""}')
+                allPages.append(f'"Actis{serverId:03d}"')
                 allServers += f'<tr id="Actis{serverId:03d}"></tr>\n'
         writeTemplateSub(open(SERVERS_HTML, "w"), SERVERS_TEMPLATE, {
                          '{Actiservers}': allServers,
                          '{allpages}': ',\n'.join(allPages),
                          '{date}': jsDateString(now()),
         })
+        feed.publish(documents=[SERVERS_HTML])
 
     def listIds(self):
         return sorted(self.servers.keys())
@@ -260,27 +357,24 @@ class ActiserversClass:
         self.servers[serverId].addActim(actimId)
 
     def removeActim(self, actimId):
-        serverId = 0
-        for s in self.servers.values():
-            if s.removeActim(actimId): serverId = s.serverId
+        serverId = self.getServerId(actimId)
+        if serverId != 0:
+            self.servers[serverId].removeActim(actimId)
         return serverId
 
     def getServerId(self, actimId):
-        for s in self.servers.values():
-            if actimId in s.actimetreList:
-                return s.serverId
-        else: return 0
+        return self.actimToServer.get(actimId, 0)
 
     def serverInfo(self, actimId):
-        for s in self.servers.values():
-            if actimId in s.actimetreList: return \
-                f'{s.name()}\n' + \
-                f'Hardware {s.machine}\nVersion {s.version}\n' + \
-                f'IP {s.ip}\nChannel {s.channel}\n' + \
-                f'Disk size {printSize(s.diskSize)}, free {printSize(s.diskFree)} ' + \
-                f'({100.0 * s.diskFree / s.diskSize :.1f}%)\n' + \
-                f'Last seen {s.lastUpdate.strftime(TIMEFORMAT_DISP)}\n'
-        return ''
+        serverId = self.getServerId(actimId)
+        if serverId == 0: return ''
+        s = self.servers[serverId]
+        return f'{s.name()}\n' + \
+            f'Hardware {s.machine}\nVersion {s.version}\n' + \
+            f'IP {s.ip}\nChannel {s.channel}\n' + \
+            f'Disk size {printSize(s.diskSize)}, free {printSize(s.diskFree)} ' + \
+            f'({100.0 * s.diskFree / s.diskSize :.1f}%)\n' + \
+            f'Last seen {s.lastUpdate.strftime(TIMEFORMAT_DISP)}\n'
 
     def getRemotes(self, serverId):
         remotes = []
@@ -308,8 +402,38 @@ class ActiserversClass:
                 s.isDown = 3
                 s.dirty = True
 
+    def processDelta(self, serverId, d):
+        # Format 2: only what changed since the heartbeat numbered base, which we acknowledged
+        oldServer = self.servers.get(serverId)
+        expected = 0 if oldServer is None else oldServer.seq
+        actimetres = {int(actimId): data for actimId, data in d.get('actimetres', {}).items()}
+        Actimetres = actimetre.Actimetres
+        if expected == 0 or int(d.get('base', 0)) != expected or \
+                not all(data is None or Actimetres.acceptsDelta(actimId, data) for actimId, data in actimetres.items()):
+            printLog(f'Actis{serverId:03d} delta on {d.get("base")}, expected {expected}, asking for all')
+            return None, set()
+
+        thisServer = copy.copy(oldServer).fromDelta(d)
+        actimetreList = set(thisServer.actimetreList)
+        for actimId, data in actimetres.items():
+            if data is None:
+                actimetreList.discard(actimId)
+            else:
+                Actimetres.deltaActual(actimId, data | {'actimId': actimId})
+                actimetreList.add(actimId)
+        thisServer.actimetreList = actimetreList
+        printLog(f'Actis{serverId:03d} delta {d["base"]}..{thisServer.seq}, {len(actimetres)} Actimetres', LOG_DEBUG)
+        return thisServer, set(actimetres.keys())
+
     def processUpdate(self, serverId, data):
-        thisServer = Actiserver(serverId).fromD(json.load(data), True)
+        # The updated server, or None if its delta doesn't apply and it should send everything
+        d = json.load(data)
+        if int(d.get('format', 1)) >= 2:
+            thisServer, changed = self.processDelta(serverId, d)
+            if thisServer is None: return None
+        else:
+            thisServer = Actiserver(serverId).fromD(d, True)
+            changed = thisServer.actimetreList
         if serverId in self.servers.keys():
             thisServer.diskLow = self.servers[serverId].diskLow
             if thisServer.diskLow == 0:
@@ -325,10 +449,15 @@ class ActiserversClass:
                     thisServer.diskLow = 0
         if not serverId in self.servers.keys():
             self.dirty = True
+        else:
+            for actimId in self.servers[serverId].actimetreList - thisServer.actimetreList:
+                self.unindexActim(actimId, serverId)
         self.servers[serverId] = thisServer
+        for actimId in thisServer.actimetreList:
+            self.indexActim(actimId, serverId)
 
         Projects = project.Projects
-        for actimId in thisServer.actimetreList:
+        for actimId in changed:
             Projects.makeDirty(actimId)
         Projects.makeStaleMaybe()
 
@@ -345,15 +474,55 @@ class ActiserversClass:
     def processForm(self, formId, args):
         print("Status: 205\n\n")
 
+    def snapshot(self):
+        return {int(s.serverId):s.toD() for s in self.servers.values()}
+
+    def saveData(self, changed):
+        if len(changed) > 0:
+            self.store.put({serverId: self.servers[serverId].toD() for serverId in changed}, self.snapshot)
+
+    def compact(self):
+        if not self.loaded(): return
+        self.store.compact(self.snapshot)
+
+    def saveUnassigned(self):
+        with self.guard:
+            unassigned = list(self.unassigned)
+        if unassigned != self.savedUnassigned:
+            dumpData(UNASSIGNED_FILE, {'unassigned': unassigned})
+            self.savedUnassigned = unassigned
+
+    def deferSave(self, pending):
+        # Save the data only, and leave the HTML to the next save()
+        if not self.loaded(): return
+        changed = set()
+        for server in self.servers.values():
+            if server.dirty:
+                pending['server'].add(server.serverId)
+                changed.add(server.serverId)
+                server.dirty = False
+        if self.dirty:
+            pending['page'].add('servers')
+        self.saveData(changed)
+        self.saveUnassigned()
+        self.dirty = False
+
+    def restore(self, pending):
+        for serverId in pending['server'] & self.servers.keys():
+            self.servers[serverId].dirty = True
+        if 'servers' in pending['page']:
+            self.dirty = True
+
     def save(self):
-        stale = False
+        if not self.loaded(): return
+        changed = set()
         for server in self.servers.values():
-            if server.save(): stale = True
+            if server.save(): changed.add(server.serverId)
         if self.dirty:
             self.htmlWrite()
-            stale = True
-        if stale:
-            dumpData(ACTISERVERS, {int(s.serverId):s.toD() for s in self.servers.values()})
+        self.saveData(changed)
+        self.saveUnassigned()
+        self.dirty = False
 
 Actiservers: ActiserversClass = ActiserversClass()
 def initActiservers() -> ActiserversClass:
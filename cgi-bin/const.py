@@ -1,6 +1,6 @@
 ### Constants and context-free functions
 
-import os, json, subprocess
+import os, re, sys, gzip, json, fcntl, atexit, hashlib, threading, subprocess
 from datetime import datetime, timedelta, timezone
 from yattag import Doc
 
@@ -11,6 +11,13 @@ HTML_ROOT       = "/var/www/html"
 ADMIN_EMAIL     = "actimetre@gmail.com"
 ADMINISTRATORS  = f"{FILE_ROOT}/administrators"
 LOG_SIZE_MAX    = 10_000_000
+LOG_KEEP        = 5         # rotated logs kept as central.log.1 to .5
+LOG_BUFFER      = 500       # lines held before writing
+LOG_DEBUG       = 10
+LOG_INFO        = 20
+LOG_LEVEL       = LOG_INFO  # LOG_DEBUG adds a line per Actimetre, Actiserver and Project saved
+JOURNAL_SIZE_MAX= 1_000_000
+JOURNAL_COMPACT = 3600      # seconds between compactions of a journal into its .data file
 
 TIMEFORMAT_UTC  = "%Y%m%d%H%M%S%z"
 TIMEFORMAT_FN   = "%Y%m%d%H%M%S"
@@ -23,10 +30,26 @@ ACTIMETRES      = f"{FILE_ROOT}/actimetres.data"
 ACTISERVERS     = f"{FILE_ROOT}/actiservers.data"
 LOG_FILE        = f"{FILE_ROOT}/central.log"
 PROJECTS        = f"{FILE_ROOT}/projects.data"
+REGISTRY_DUMP   = f"{FILE_ROOT}/registry.dump"
+PROJECTS_DUMP   = f"{FILE_ROOT}/projects.dump"
+REGISTRY_CHANGES= f"{FILE_ROOT}/registry.changes"
+PROJECTS_CHANGES= f"{FILE_ROOT}/projects.changes"
+UNASSIGNED_KEEP = 32        # Actimetres on no server, sent to every server asking for its own registry
+CHANGES_KEEP    = 200       # versions an Actiserver can catch up from, older ones get the whole map
 LOCK_FILE       = f"{FILE_ROOT}/acticentral.lock"
+PID_FILE        = f"{FILE_ROOT}/acticentral.pid"
+PENDING_FILE    = f"{FILE_ROOT}/pending.data"
+UNASSIGNED_FILE = f"{FILE_ROOT}/unassigned.data"
+DATABASE        = f"{FILE_ROOT}/acticentral.db"
+STORAGE         = "json"    # or "sqlite", after running acticentral.py migrate-storage
+RENDER_DEFERRED = True      # heartbeats save the data only, prepare-stats writes the HTML and graphs
 SECRET_FILE     = f"{FILE_ROOT}/.secret"
 HISTORY_DIR     = f"{FILE_ROOT}/history"
+RENDERED_DIR    = f"{FILE_ROOT}/rendered"   # a stamp per page, touched when it is rendered unchanged
+HISTORY_FORMAT  = "text"    # or "binary", after running acticentral.py import-history
 IMAGES_DIR      = f"{HTML_ROOT}/images"
+GRAPH_MATPLOTLIB= False     # draw the health graphs with matplotlib instead of plain SVG
+GRAPH_WORKERS   = min(4, os.cpu_count() or 1)
 INDEX_NAME      = "acticentral.html"
 ACTIM_HTML_DIR  = f"{HTML_ROOT}/actimetre"
 SERVER_HTML_DIR = f"{HTML_ROOT}/actiserver"
@@ -55,6 +78,24 @@ ACTIS_ALERT1    = timedelta(minutes=5)
 ACTIS_ALERT2    = timedelta(minutes=30)
 ACTIS_ALERT3    = timedelta(hours=8)
 
+RESIDENT_ADDRESS= ("127.0.0.1", 8472)
+RESIDENT_PATH   = "/bin/acticentral.py"
+RESIDENT_TIMEOUT= 60
+RESIDENT_FLUSH  = timedelta(seconds=10)
+RESIDENT_TICK   = timedelta(minutes=1)
+SENDMAIL        = "/usr/sbin/sendmail"   # or sendmail-local.sh to keep the mails in a file
+MAIL_SPOOL      = f"{FILE_ROOT}/mail"
+MAIL_TIMEOUT    = 60        # seconds for one sendmail run
+MAIL_RETRIES    = 8
+MAIL_BACKOFF    = 60        # seconds before the first retry, doubled at each failure
+ALERT_WINDOW    = 120       # seconds to gather alerts into one digest per recipient and level
+GZIP_MIN        = 512       # bytes, smaller replies go out as they are
+GZIP_LEVEL      = 6
+GZIP_CACHE      = 16        # compressed bodies kept, a dump repeats until the registry or projects change
+FEED_QUEUE      = 1000      # events waiting for one dashboard before it is dropped
+FEED_KEEPALIVE  = 15        # seconds
+FEED_RETRY      = 5000      # milliseconds
+
 ACTIS_FAIL_TIME = timedelta(seconds=60)
 ACTIS_RETIRE_P  = timedelta(days=30)
 ACTIM_RETIRE_P  = timedelta(days=30)
@@ -66,18 +107,55 @@ TIMEZERO        = datetime(year=2023, month=1, day=1, tzinfo=timezone.utc)
 NOW             = now()
 LAST_UPDATED    = NOW.strftime(TIMEFORMAT_DISP)
 
+def setNow(at=None):
+    # A resident process serves many requests: refresh NOW in every module that imported it
+    global NOW, LAST_UPDATED
+    NOW = now() if at is None else at
+    LAST_UPDATED = NOW.strftime(TIMEFORMAT_DISP)
+    CONSTANT["{Updated}"] = LAST_UPDATED
+    for module in list(sys.modules.values()):
+        if getattr(module, 'setNow', None) is setNow:
+            module.NOW = NOW
+            module.LAST_UPDATED = LAST_UPDATED
+
 REMOTE_SWITCH   = 0x10
 REMOTE_SYNC     = 0x20
 REMOTE_STOP     = 0x30
 REMOTE_RESTART  = 0xF0
 
-def printLog(text=''):
-    try:
-        if os.stat(LOG_FILE).st_size > LOG_SIZE_MAX:
-            os.truncate(LOG_FILE, 0)
-    except OSError: pass
-    with open(LOG_FILE, 'a') as logfile:
-        print(f'[{NOW.strftime(TIMEFORMAT_DISP)}]', text, file=logfile)
+LogLines: list[str] = []
+LogGuard = threading.Lock()
+
+def printLog(text='', level=LOG_INFO):
+    if level < LOG_LEVEL: return
+    with LogGuard:
+        LogLines.append(f'[{NOW.strftime(TIMEFORMAT_DISP)}] {text}\n')
+        full = len(LogLines) >= LOG_BUFFER
+    if full: flushLog()
+
+def flushLog():
+    # Write the buffered lines in one go, rotating the log when it is too big
+    with LogGuard:
+        if len(LogLines) == 0: return
+        lines = ''.join(LogLines)
+        LogLines.clear()
+        try:
+            with open(LOG_FILE, 'a') as logfile:
+                fcntl.flock(logfile, fcntl.LOCK_EX)
+                if os.fstat(logfile.fileno()).st_size > LOG_SIZE_MAX and \
+                   os.fstat(logfile.fileno()).st_ino == os.stat(LOG_FILE).st_ino:
+                    for generation in range(LOG_KEEP - 1, 0, -1):
+                        if os.path.isfile(f'{LOG_FILE}.{generation}'):
+                            os.replace(f'{LOG_FILE}.{generation}', f'{LOG_FILE}.{generation + 1}')
+                    os.replace(LOG_FILE, f'{LOG_FILE}.1')
+                    with open(LOG_FILE, 'a') as newfile:
+                        newfile.write(lines)
+                else:
+                    logfile.write(lines)
+        except OSError:
+            pass
+
+atexit.register(flushLog)
 
 def loadData(filename):
     try:
@@ -91,13 +169,53 @@ def loadData(filename):
         printLog(f"Decode error in {filename}")
         data = {}
     registry.close()
+    try:
+        with open(journalFile(filename), "r") as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    printLog(f"Truncated journal {journalFile(filename)}")
+                    break
+                if entry['data'] is None:
+                    data.pop(entry['id'], None)
+                else:
+                    data[entry['id']] = entry['data']
+    except OSError:
+        pass
 #    printLog(f"Loaded from {filename}: {len(data)} items")
     return data
 
 def dumpData(filename, data):
     printLog(f"[DUMP {filename}]")
-    with open(filename, "w") as registry:
+    with open(filename + ".tmp", "w") as registry:
         json.dump(data, registry)
+    os.replace(filename + ".tmp", filename)
+    try:
+        os.remove(journalFile(filename))
+    except OSError:
+        pass
+
+def journalFile(filename):
+    return filename + ".journal"
+
+def journalData(filename, changes, snapshot):
+    # Append the changed records only, or rewrite the whole file once the journal is too long
+    try:
+        size = os.stat(journalFile(filename)).st_size
+    except OSError:
+        size = 0
+    if size > JOURNAL_SIZE_MAX:
+        dumpData(filename, snapshot())
+        return
+    printLog(f"[JOURNAL {filename}] {' '.join(str(itemId) for itemId in changes.keys())}", LOG_DEBUG)
+    with open(journalFile(filename), "a") as journal:
+        journal.write(''.join(json.dumps({'id': str(itemId), 'data': data}) + '\n'
+                              for itemId, data in changes.items()))
+
+def compactData(filename, snapshot):
+    if os.path.isfile(journalFile(filename)) and fileOlderThan(filename, JOURNAL_COMPACT):
+        dumpData(filename, snapshot())
 
 def printSize(size, unit='', precision=0):
     if size == 0:
@@ -128,33 +246,15 @@ def utcStrptime(string):
     return datetime.strptime(string.strip() + "+0000", TIMEFORMAT_UTC)
 
 def sendEmail(recipient, subject, text):
-    content = f"""\
-Subject:{subject}
-This alert triggered at {NOW.strftime(TIMEFORMAT_ALERT)}
-
-{text}
-
------------------------------------------------
-For more information, please visit actimetre.fr
-.
-"""
-    if recipient != "":
-        result = subprocess.run(["/usr/sbin/sendmail", "-F", "Acticentral", recipient],
-                                input = content, text=True, stderr=subprocess.STDOUT)
-        printLog(f'Email sent to "{recipient}", sendmail returns {result.returncode}: {result.stdout}')
-    else:
-        try:
-            admins = open(ADMINISTRATORS, "r")
-        except OSError:
-            result = subprocess.run(["/usr/sbin/sendmail", "-F", "Acticentral", ADMIN_EMAIL],
-                                    input = content, text=True, stderr=subprocess.STDOUT)
-            printLog(f'Email sent to "{ADMIN_EMAIL}", sendmail returns {result.returncode}: {result.stdout}')
-        else:
-            for email in admins:
-                result = subprocess.run(["/usr/sbin/sendmail", "-F", "Acticentral", email.strip()],
-                                        input = content, text=True, stderr=subprocess.STDOUT)
-                printLog(f'Email sent to "{email.strip()}", sendmail returns {result.returncode}: {result.stdout}')
-            admins.close()
+    from mailer import recipients, mailContent, enqueue
+    for email in recipients(recipient):
+        enqueue(email, mailContent(subject, text))
+
+def sendAlert(recipient, level, subject, text, context=""):
+    # Held for ALERT_WINDOW, then sent with the others of the same level as one digest
+    from mailer import recipients, queueAlert
+    for email in recipients(recipient):
+        queueAlert(email, level, subject, text, context)
 
 def htmlRssi(rssi):
     doc, tag, text, line = Doc().ttl()
@@ -179,18 +279,148 @@ CONSTANT = {
     "{Index}"      : INDEX_NAME,
 }
 
+PLACEHOLDER = re.compile(r'\{[A-Za-z]+\}')
+Templates: dict[str, tuple[float, list[str]]] = {}
+
+def compileTemplate(template: str) -> list[str]:
+    # Text and placeholders alternate: even items are text, odd items are placeholders
+    mtime = os.stat(template).st_mtime
+    cached = Templates.get(template)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with open(template, "r") as source:
+        content = source.read()
+    parts = []
+    start = 0
+    for match in PLACEHOLDER.finditer(content):
+        parts += [content[start:match.start()], match.group()]
+        start = match.end()
+    parts.append(content[start:])
+    Templates[template] = (mtime, parts)
+    return parts
+
 def writeTemplateSub(output, template: str, substitutions: dict[str,str]):
-    content = open(template, "r").read()
-    for before, after in substitutions.items():
-        content = content.replace(before, after)
-    for before, after in CONSTANT.items():
-        content = content.replace(before, after)
+    parts = compileTemplate(template)
+    content = ''.join(part if index % 2 == 0 else substitutions.get(part, CONSTANT.get(part, part))
+                      for index, part in enumerate(parts))
     print(content, file=output)
     return content
 
-def plain(text=''):
-    print("Content-type: text/plain\n\n")
-    print(text)
+FileHashes: dict[str, bytes] = {}
+
+def writeIfChanged(filename, content: str) -> bool:
+    # Leave the file and its mtime alone when it already holds these bytes, the feed goes by mtime
+    data = content.encode()
+    digest = hashlib.blake2b(data, digest_size=16).digest()
+    known = FileHashes.get(filename)
+    if known is None or not os.path.isfile(filename):
+        try:
+            with open(filename, "rb") as existing:
+                known = hashlib.blake2b(existing.read(), digest_size=16).digest()
+        except OSError:
+            known = None
+    FileHashes[filename] = digest
+    if known == digest:
+        markRendered(filename)
+        return False
+    with open(filename, "wb") as output:
+        output.write(data)
+    return True
+
+def renderStamp(filename):
+    return f'{RENDERED_DIR}/{filename.strip("/").replace("/", "%")}'
+
+def markRendered(filename):
+    # So that the stale checks see the file fresh without touching it
+    stamp = renderStamp(filename)
+    try:
+        os.utime(stamp)
+    except FileNotFoundError:
+        try:
+            os.makedirs(RENDERED_DIR, exist_ok=True)
+            open(stamp, "w").close()
+            os.chmod(stamp, 0o666)
+        except OSError:
+            pass
+    except OSError:
+        pass
+
+def renderedAt(filename) -> datetime:
+    # Written or rendered unchanged, whichever is later
+    mtime = os.stat(filename).st_mtime
+    try:
+        mtime = max(mtime, os.stat(renderStamp(filename)).st_mtime)
+    except OSError:
+        pass
+    return datetime.fromtimestamp(mtime, timezone.utc)
+
+Gzipped: dict[bytes, bytes] = {}
+GzipGuard = threading.Lock()
+
+def gzipped(body: str) -> bytes:
+    data = body.encode()
+    digest = hashlib.blake2b(data, digest_size=16).digest()
+    with GzipGuard:
+        compressed = Gzipped.pop(digest, None)
+        if compressed is None:
+            compressed = gzip.compress(data, GZIP_LEVEL, mtime=0)
+        Gzipped[digest] = compressed
+        while len(Gzipped) > GZIP_CACHE:
+            del Gzipped[next(iter(Gzipped))]
+    return compressed
+
+def plain(text='', gzipOk=False):
+    body = f'\n{text}\n'
+    if gzipOk and len(body) >= GZIP_MIN:
+        print("Content-type: text/plain\nContent-Encoding: gzip\nVary: Accept-Encoding\n")
+        sys.stdout.flush()
+        sys.stdout.buffer.write(gzipped(body))
+        sys.stdout.buffer.flush()
+    else:
+        print("Content-type: text/plain\n\n")
+        print(text)
+
+def writeDump(filename, text):
+    # The reply to action=registry or projects, as plain() would send it, after its ETag
+    body = f'\n{text}\n'
+    etag = hashlib.blake2b(body.encode(), digest_size=16).hexdigest()
+    versions = [(filename, body.encode())]
+    if len(body) >= GZIP_MIN:
+        versions.append((filename + '.gz', gzipped(body)))
+    else:
+        try:
+            os.remove(filename + '.gz')
+        except OSError:
+            pass
+    # Readers under the shared lock may write it at the same time, each from its own temporary file
+    suffix = f'.{os.getpid()}-{threading.get_ident()}.tmp'
+    for name, data in versions:
+        with open(name + suffix, "wb") as dump:
+            dump.write(f'{etag}\n'.encode() + data)
+        os.replace(name + suffix, name)
+
+def serveDump(filename, ifNoneMatch, gzipOk):
+    # Returns False if the dump was never written
+    for name, compressed in ((filename + '.gz', True), (filename, False)):
+        if compressed and not gzipOk: continue
+        try:
+            with open(name, "rb") as dump:
+                etag, separator, body = dump.read().partition(b'\n')
+            break
+        except OSError:
+            pass
+    else:
+        return False
+    etag = f'"{etag.decode()}"'
+    if etag in ifNoneMatch:
+        print(f'Status: 304\nETag: {etag}\n')
+        return True
+    print(f'Content-type: text/plain\nETag: {etag}\nVary: Accept-Encoding' +
+          ('\nContent-Encoding: gzip\n' if compressed else '\n'))
+    sys.stdout.flush()
+    sys.stdout.buffer.write(body)
+    sys.stdout.buffer.flush()
+    return True
 
 def printTimeAgo(since: datetime):
     span = NOW - since
@@ -209,7 +439,7 @@ def printTimeAgo(since: datetime):
 
 def fileOlderThan(filename: str, seconds: int) -> bool:
     return not os.path.isfile(filename) or \
-        NOW - datetime.fromtimestamp(os.stat(filename).st_mtime, timezone.utc) > timedelta(seconds=seconds)
+        NOW - renderedAt(filename) > timedelta(seconds=seconds)
 
 def fileNeedsUpdate(filename: str, lastUpdate: datetime, minPeriod: timedelta = None) -> bool:
     if not os.path.isfile(filename): return True
@@ -220,7 +450,7 @@ def fileNeedsUpdate(filename: str, lastUpdate: datetime, minPeriod: timedelta =
         elif elapsed > timedelta(days=1): period = timedelta(hours=1)
         else: period = timedelta(minutes=1)
         if minPeriod is not None and period < minPeriod: period = minPeriod
-        return NOW - datetime.fromtimestamp(os.stat(filename).st_mtime, timezone.utc) > period
+        return NOW - renderedAt(filename) > period
 
 Weekday = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
 Month = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
@@ -0,0 +1,130 @@
+### What changed in the HTML fragments and graphs, for the dashboard pages
+
+import re, time, queue, threading
+from const import *
+
+FRAGMENT_ID = re.compile(r'(Actim|Actis|Project|Image)(\d{1,4})')
+
+def fragmentFile(fragmentId):
+    match = FRAGMENT_ID.fullmatch(fragmentId)
+    if match is None: return None
+    kind, number = match[1], int(match[2])
+    if kind == 'Actim': return f'{ACTIM_HTML_DIR}/actim{number:04d}.html'
+    if kind == 'Actis': return f'{SERVER_HTML_DIR}/server{number:03d}.html'
+    if kind == 'Project': return f'{PROJECT_DIR}/project{number:02d}.html'
+    return f'{IMAGES_DIR}/actim{number:04d}.svg'
+
+def pageFile(path):
+    if path.endswith('/'): path += INDEX_NAME
+    filename = os.path.normpath(HTML_ROOT + '/' + path)
+    if not filename.startswith(HTML_ROOT + '/') or not filename.endswith('.html'):
+        return None
+    return filename
+
+def imageRef(filename, mtime):
+    return f'{filename[len(HTML_ROOT):]}?v={int(mtime)}'
+
+def modified(filename):
+    try:
+        return os.stat(filename).st_mtime
+    except OSError:
+        return None
+
+def changes(query):
+    # Fragments and images written since the last call, and whether the page itself was rewritten
+    started = time.time()
+    since = float(query.get('since', 0))
+    pages = {}
+    for pageId in query.get('ids', []):
+        filename = fragmentFile(pageId)
+        if filename is None or filename.endswith('.svg'): continue
+        mtime = modified(filename)
+        if mtime is not None and mtime >= since:
+            with open(filename, "r") as fragment:
+                pages[pageId] = fragment.read()
+    images = {}
+    for imageId in query.get('images', []):
+        filename = fragmentFile(imageId)
+        if filename is None or not filename.endswith('.svg'): continue
+        mtime = modified(filename)
+        if mtime is not None and mtime >= since:
+            images[imageId] = imageRef(filename, mtime)
+    reload = False
+    filename = pageFile(query.get('page', ''))
+    if filename is not None:
+        mtime = modified(filename)
+        reload = mtime is not None and int(mtime) > int(query.get('loaded', 0))
+    return {'now': started, 'reload': reload, 'pages': pages, 'images': images, 'documents': []}
+
+def respond(data):
+    try:
+        query = json.loads(data.read() or '{}')
+        reply = changes(query)
+    except (json.JSONDecodeError, AttributeError, TypeError, ValueError):
+        print("Status: 400\n\n")
+        return
+    print("Content-type: application/json\nCache-Control: no-store\n")
+    print(json.dumps(reply))
+
+class SubscribersClass:
+    # The event streams open in the resident process, each with its own queue
+    def __init__(self):
+        self.queues: set[queue.Queue] = set()
+        self.guard = threading.Lock()
+
+    def add(self):
+        events = queue.Queue(maxsize=FEED_QUEUE)
+        with self.guard:
+            self.queues.add(events)
+        return events
+
+    def remove(self, events):
+        with self.guard:
+            self.queues.discard(events)
+
+    def publish(self, event):
+        with self.guard:
+            queues = list(self.queues)
+        for events in queues:
+            try:
+                events.put_nowait(event)
+            except queue.Full:
+                # Too slow: end its stream, the browser reconnects and catches up with a feed request
+                self.remove(events)
+                with events.mutex:
+                    events.queue.clear()
+                events.put_nowait(None)
+
+Subscribers = SubscribersClass()
+
+def publish(*, pages=None, images=(), documents=()):
+    if len(Subscribers.queues) == 0: return
+    event = {'now': time.time(), 'reload': False, 'pages': pages or {},
+             'images': {}, 'documents': []}
+    for imageId in images:
+        filename = fragmentFile(imageId)
+        mtime = modified(filename)
+        if mtime is not None:
+            event['images'][imageId] = imageRef(filename, mtime)
+    for filename in documents:
+        path = filename[len(HTML_ROOT):]
+        event['documents'].append(path)
+        if path == '/' + INDEX_NAME:
+            event['documents'].append('/')
+    Subscribers.publish(event)
+
+def stream():
+    # Server-Sent Events for one dashboard, until it goes away
+    events = Subscribers.add()
+    try:
+        yield f'retry: {FEED_RETRY}\n\n'.encode()
+        while True:
+            try:
+                event = events.get(timeout=FEED_KEEPALIVE)
+            except queue.Empty:
+                yield b': keepalive\n\n'
+                continue
+            if event is None: break
+            yield f'data: {json.dumps(event)}\n\n'.encode()
+    finally:
+        Subscribers.remove(events)
@@ -1,9 +1,14 @@
 from const import *
+import mmap, bisect, time
+from array import array
+from contextlib import contextmanager
 
 from actimetre import Actimetre
+import feed
 
 FSCALE       = {100:2, 1000:5, 4000:10}
 FSCALETAG    = {100:2, 1000:5, 4000:10}
+HISTORY_TAIL = 64       # enough bytes to hold the last line of a .hist file
 
 def scaleFreq(origFreq):
     if origFreq == 0:
@@ -13,131 +18,367 @@ def scaleFreq(origFreq):
             return scale
     return origFreq // 40
 
+def toEpoch(time: datetime) -> int:
+    return int(time.timestamp())
+
+def fromEpoch(seconds: int) -> datetime:
+    return datetime.fromtimestamp(seconds, timezone.utc)
+
+class HistoryStore:
+    def __init__(self, path: str):
+        self.path = path
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            return False
+        return True
+
+class TextHistory(HistoryStore):
+    # One "YYYYmmddHHMMSS:frequency" line per event
+    def __init__(self, actimId: int):
+        super().__init__(f'{HISTORY_DIR}/actim{actimId:04d}.hist')
+
+    def first(self):
+        try:
+            with open(self.path, "r") as history:
+                timeStr = history.readline().partition(':')[0]
+        except FileNotFoundError:
+            return None
+        if timeStr.strip() == "": return None
+        return toEpoch(utcStrptime(timeStr))
+
+    def last(self):
+        # Appending only needs the last event, so read just the tail of the file
+        try:
+            with open(self.path, "rb") as history:
+                size = history.seek(0, os.SEEK_END)
+                history.seek(max(0, size - HISTORY_TAIL))
+                lines = history.read().decode().split()
+        except FileNotFoundError:
+            return None
+        if len(lines) == 0:
+            return toEpoch(TIMEZERO), 0
+        timeStr, part, freqStr = lines[-1].partition(':')
+        return toEpoch(utcStrptime(timeStr)), int(freqStr)
+
+    def read(self, since=0):
+        times = []
+        frequencies = []
+        try:
+            with open(self.path, "r") as history:
+                for line in history:
+                    timeStr, part, freqStr = line.partition(':')
+                    if timeStr.strip() == "": continue
+                    time = toEpoch(utcStrptime(timeStr))
+                    if len(times) > 0 or time >= since:
+                        times.append(time)
+                        frequencies.append(int(freqStr))
+        except FileNotFoundError:
+            return None
+        return times, frequencies
+
+    def append(self, time, frequency):
+        with open(self.path, "a") as history:
+            print(fromEpoch(time).strftime(TIMEFORMAT_FN), frequency, sep=":", file=history)
+
+    def write(self, times, frequencies):
+        with open(self.path, "w") as history:
+            for time, frequency in zip(times, frequencies):
+                print(fromEpoch(time).strftime(TIMEFORMAT_FN), frequency, sep=":", file=history)
+
+class BinaryHistory(HistoryStore):
+    # Fixed-width (epoch seconds, frequency) int64 pairs, read through mmap
+    RECORD = 2 * array('q').itemsize
+
+    def __init__(self, actimId: int):
+        super().__init__(f'{HISTORY_DIR}/actim{actimId:04d}.bhist')
+
+    @contextmanager
+    def mapped(self):
+        try:
+            history = open(self.path, "rb")
+        except FileNotFoundError:
+            yield None
+            return
+        with history:
+            size = os.fstat(history.fileno()).st_size
+            size -= size % self.RECORD
+            if size == 0:
+                yield memoryview(b'').cast('q')
+                return
+            with mmap.mmap(history.fileno(), size, access=mmap.ACCESS_READ) as raw, \
+                 memoryview(raw) as view, view.cast('q') as records:
+                yield records
+
+    def first(self):
+        with self.mapped() as records:
+            if records is None or len(records) == 0: return None
+            return records[0]
+
+    def last(self):
+        with self.mapped() as records:
+            if records is None: return None
+            if len(records) == 0: return toEpoch(TIMEZERO), 0
+            return records[-2], records[-1]
+
+    def read(self, since=0):
+        with self.mapped() as records:
+            if records is None: return None
+            start = bisect.bisect_left(records[0::2], since)
+            return records[2 * start::2].tolist(), records[2 * start + 1::2].tolist()
+
+    def append(self, time, frequency):
+        with open(self.path, "ab") as history:
+            history.write(array('q', (time, frequency)).tobytes())
+
+    def write(self, times, frequencies):
+        records = array('q')
+        for time, frequency in zip(times, frequencies):
+            records.extend((time, frequency))
+        with open(self.path + '.tmp', "wb") as history:
+            history.write(records.tobytes())
+        os.replace(self.path + '.tmp', self.path)
+
+def historyStore(actimId: int) -> HistoryStore:
+    if HISTORY_FORMAT == 'binary':
+        return BinaryHistory(actimId)
+    else:
+        return TextHistory(actimId)
+
+def importHistories():
+    # Copy every text history into the binary format, the .hist files are left in place
+    count = 0
+    for filename in sorted(os.listdir(HISTORY_DIR)):
+        if filename.startswith('actim') and filename.endswith('.hist'):
+            actimId = int(filename[5:9])
+            BinaryHistory(actimId).write(*TextHistory(actimId).read())
+            count += 1
+    printLog(f'Imported {count} histories into {HISTORY_DIR}')
+    return count
+
+def tagText(real):
+    if real >= 1000:
+        return f" {real // 1000 :2d}k"
+    else:
+        return f" {real:3d}"
+
+SVG_WIDTH   = 290       # user units, same as the matplotlib figure in points
+SVG_HEIGHT  = 55
+SVG_PLOT    = 254       # the frequency tags are right of the plot
+SVG_YRANGE  = (-1, 12)
+
+def svgGraph(timeline, frequencies, scaledFreqNow, frequency, now):
+    # Same drawing as plotGraph, written straight as SVG text
+    start = timeline[0].timestamp()
+    span = max(now.timestamp() - start, 1.0)
+    left = start - 0.05 * span
+    width = 1.1 * span
+    def x(time: datetime):
+        return f'{SVG_PLOT * (time.timestamp() - left) / width:.2f}'
+    def y(value):
+        bottom, top = SVG_YRANGE
+        return f'{SVG_HEIGHT * (top - value) / (top - bottom):.2f}'
+
+    doc, tag, text, line = Doc().ttl()
+    with tag('svg', xmlns="http://www.w3.org/2000/svg", version="1.1",
+             width=f'{SVG_WIDTH}pt', height=f'{SVG_HEIGHT}pt', viewBox=f'0 0 {SVG_WIDTH} {SVG_HEIGHT}'):
+        doc.stag('rect', width=SVG_WIDTH, height=SVG_HEIGHT, fill="#ffffff")
+        bootTop = f'{SVG_HEIGHT * 0.05:.2f}'
+        doc.stag('line', ('stroke-width', 1), x1=x(timeline[0]), x2=x(timeline[0]),
+                 y1=SVG_HEIGHT, y2=bootTop, stroke="blue")
+        boot, top = float(x(timeline[0])), float(bootTop)
+        doc.stag('polygon', fill="blue", stroke="blue",
+                 points=f'{boot:.2f},{top - 2.5:.2f} {boot - 2.5:.2f},{top + 2.5:.2f} {boot + 2.5:.2f},{top + 2.5:.2f}')
+
+        steps = f'M {x(timeline[0])} {y(frequencies[0])}'
+        for index in range(1, len(timeline)):
+            steps += f' H {x(timeline[index])} V {y(frequencies[index])}'
+        doc.stag('path', ('stroke-width', 1), ('stroke-linejoin', 'miter'), d=steps, fill="none", stroke="black")
+        # An empty history has only NOW, and no last segment, like plotGraph
+        if len(timeline) >= 2:
+            doc.stag('path', ('stroke-width', 3), d=f'M {x(timeline[-2])} {y(scaledFreqNow)} H {x(timeline[-1])}',
+                     fill="none", stroke="red" if scaledFreqNow == 0 else "green")
+
+        for real, drawn in FSCALETAG.items():
+            line('text', tagText(real), ('font-family', 'sans-serif'), ('font-stretch', 'condensed'),
+                 ('font-size', 10), ('font-weight', 'bold' if frequency == real else 'normal'),
+                 ('dominant-baseline', 'central'), ('xml:space', 'preserve'),
+                 x=x(now), y=y(drawn), fill="green" if frequency == real else "black")
+    return doc.getvalue()
+
+def plotGraph(timeline, frequencies, scaledFreqNow, frequency, now):
+    os.environ['MPLCONFIGDIR'] = "/etc/matplotlib"
+    import io
+    import matplotlib.pyplot as pyplot
+    pyplot.rcParams['svg.hashsalt'] = 'acticentral'
+
+    rowFreqNow = [scaledFreqNow for _ in range(len(timeline))]
+    fig, ax = pyplot.subplots(figsize=(5.0,1.0), dpi=50.0)
+    ax.set_axis_off()
+    ax.set_ylim(bottom=-1, top=12)
+    ax.axvline(timeline[0], 0, 0.95, lw=1.0, c="blue", marker="^", markevery=[1], ms=5.0, mfc="blue")
+    for real, drawn in FSCALETAG.items():
+        if frequency == real:
+            c = 'green'
+            w = 'bold'
+        else:
+            c = 'black'
+            w = 'regular'
+        ax.text(now, drawn, tagText(real), family="sans-serif", stretch="condensed", ha="left", va="center", c=c, weight=w)
+
+    ax.plot(timeline, frequencies, ds="steps-post", c="black", lw=1.0, solid_joinstyle="miter")
+    if scaledFreqNow == 0:
+        ax.plot(timeline[-2:], rowFreqNow[-2:], ds="steps-post", c="red", lw=3.0)
+    else:
+        ax.plot(timeline[-2:], rowFreqNow[-2:], ds="steps-post", c="green", lw=3.0)
+    image = io.BytesIO()
+    pyplot.savefig(image, format='svg', bbox_inches="tight", pad_inches=0, metadata={'Date': None})
+    pyplot.close()
+    return image.getvalue().decode()
+
 class ActimHistory:
     def __init__(self, actim):
         self.a: Actimetre = actim
         self.dirty = False
-        self.histFile  = f'{HISTORY_DIR}/actim{self.a.actimId:04d}.hist'
+        self.store     = historyStore(self.a.actimId)
+        self.histFile  = self.store.path
         self.imageFile = f'{IMAGES_DIR}/actim{self.a.actimId:04d}.svg'
+        self.lastEvent = None
         if not os.path.isfile(self.histFile):
             self.lastDrawn = TIMEZERO
-            self.graphSince = TIMEZERO
         else:
             self.lastDrawn = datetime.fromtimestamp(os.stat(self.histFile).st_mtime, timezone.utc)
-        try:
-            with open(self.histFile, "r") as history:
-                self.graphSince = utcStrptime(history.readline().partition(':')[0])
-        except FileNotFoundError:
-            self.graphSince = TIMEZERO
+        since = self.store.first()
+        self.graphSince = TIMEZERO if since is None else fromEpoch(since)
 
     def cutHistory(self):
         printLog(f'Actim{self.a.actimId:04d} cut history to {self.a.bootTime.strftime(TIMEFORMAT_DISP)}')
-        freshLines = list()
-        try:
-            with open(self.histFile, "r") as history:
-                for line in history:
-                    timeStr, part, freqStr = line.partition(':')
-                    time = utcStrptime(timeStr.strip())
-                    freq = int(freqStr)
-                    if time >= self.a.bootTime:
-                        freshLines.append(f"{time.strftime(TIMEFORMAT_FN)}:{freq}")
-                        freshLines.extend(history.readlines())
-        except FileNotFoundError:
-            pass
-
-        if len(freshLines) == 0:
+        events = self.store.read(toEpoch(self.a.bootTime))
+        if events is None or len(events[0]) == 0:
             printLog(f'Actm{self.a.actimId:04d} has no history')
-            try:
-                os.remove(self.histFile)
-            except FileNotFoundError:
-                pass
-            else:
+            if self.store.remove():
                 self.a.dirty = True
         else:
-            with open(self.histFile, "w") as history:
-                for line in freshLines:
-                    print(line.strip(), file=history)
+            self.store.write(*events)
             self.a.dirty = True
+        self.lastEvent = None
 
-    def drawGraph(self):
-        os.environ['MPLCONFIGDIR'] = "/etc/matplotlib"
-        import matplotlib.pyplot as pyplot
-
-        printLog(f'Actim{self.a.actimId:04d}.lastDrawn = {self.lastDrawn.strftime(TIMEFORMAT_DISP)}')
-
+    def graphData(self):
         timeline = []
         frequencies = []
         scaledFreqNow = 0
-        try:
-            with open(f"{HISTORY_DIR}/actim{self.a.actimId:04d}.hist", "r") as history:
-                for line in history:
-                    timeStr, part, freqStr = line.partition(':')
-                    time = utcStrptime(timeStr.strip())
-                    scaledFreqNow = scaleFreq(int(freqStr))
-                    if len(timeline) == 0 or scaledFreqNow != frequencies[-1]:
-                        timeline.append(time)
-                        frequencies.append(scaledFreqNow)
-        except FileNotFoundError:
+        events = self.store.read()
+        if events is None:
             timeline.append(TIMEZERO)
             frequencies.append(scaleFreq(self.a.frequency))
+        else:
+            for time, freq in zip(*events):
+                scaledFreqNow = scaleFreq(freq)
+                if len(timeline) == 0 or scaledFreqNow != frequencies[-1]:
+                    timeline.append(fromEpoch(time))
+                    frequencies.append(scaledFreqNow)
 
         timeline.append(NOW)
         frequencies.append(scaledFreqNow)
-        rowFreqNow = [scaledFreqNow for _ in range(len(timeline))]
-
-        fig, ax = pyplot.subplots(figsize=(5.0,1.0), dpi=50.0)
-        ax.set_axis_off()
-        ax.set_ylim(bottom=-1, top=12)
-        ax.axvline(timeline[0], 0, 0.95, lw=1.0, c="blue", marker="^", markevery=[1], ms=5.0, mfc="blue")
-        fscale = FSCALETAG
-        for real, drawn in fscale.items():
-            if self.a.frequency == real:
-                c = 'green'
-                w = 'bold'
-            else:
-                c = 'black'
-                w = 'regular'
-            if real >= 1000:
-                real = f" {real // 1000 :2d}k"
-            else:
-                real = f" {real:3d}"
-            ax.text(NOW, drawn, real, family="sans-serif", stretch="condensed", ha="left", va="center", c=c, weight=w)
-
-        ax.plot(timeline, frequencies, ds="steps-post", c="black", lw=1.0, solid_joinstyle="miter")
-        if scaledFreqNow == 0:
-            ax.plot(timeline[-2:], rowFreqNow[-2:], ds="steps-post", c="red", lw=3.0)
+        return timeline, frequencies, scaledFreqNow
+
+    def drawGraph(self):
+        printLog(f'Actim{self.a.actimId:04d}.lastDrawn = {self.lastDrawn.strftime(TIMEFORMAT_DISP)}', LOG_DEBUG)
+        timeline, frequencies, scaledFreqNow = self.graphData()
+        if GRAPH_MATPLOTLIB:
+            image = plotGraph(timeline, frequencies, scaledFreqNow, self.a.frequency, NOW)
         else:
-            ax.plot(timeline[-2:], rowFreqNow[-2:], ds="steps-post", c="green", lw=3.0)
-        pyplot.savefig(f"{IMAGES_DIR}/actim{self.a.actimId:04d}.svg", format='svg', bbox_inches="tight", pad_inches=0)
-        pyplot.close()
-        try:
-            os.chmod(f"{IMAGES_DIR}/actim{self.a.actimId:04d}.svg", 0o666)
-        except OSError:
-            pass
+            image = svgGraph(timeline, frequencies, scaledFreqNow, self.a.frequency, NOW)
         self.lastDrawn = now()
+        if writeIfChanged(self.imageFile, image):
+            try:
+                os.chmod(self.imageFile, 0o666)
+            except OSError:
+                pass
+            feed.publish(images=[f'Image{self.a.actimId:04d}'])
+            return True
+        return False
 
     def drawGraphMaybe(self):
         if NOW - self.a.lastSeen < ACTIM_RETIRE_P:
-            if (self.dirty or
+            if (self.dirty or self.a.graphDirty or
                 fileNeedsUpdate(self.imageFile, self.a.bootTime, timedelta(minutes=5))):
-                printLog(f'Actim{self.a.actimId:04d}.lastDrawn = {self.lastDrawn.strftime(TIMEFORMAT_DISP)} vs. {NOW.strftime(TIMEFORMAT_DISP)}')
-                self.drawGraph()
+                printLog(f'Actim{self.a.actimId:04d}.lastDrawn = {self.lastDrawn.strftime(TIMEFORMAT_DISP)} vs. {NOW.strftime(TIMEFORMAT_DISP)}', LOG_DEBUG)
+                # Only the batch draws, outside of a batch the graph waits marked for the next one
+                self.a.graphDirty = not Graphs.defer(self.a)
+
+    def readLastEvent(self):
+        last = self.store.last()
+        if last is None:
+            return TIMEZERO, None
+        return fromEpoch(last[0]), last[1]
 
     def addFreqEvent(self, x, frequency):
-        try:
-            with open(f"{HISTORY_DIR}/actim{self.a.actimId:04d}.hist", "r+") as history:
-                time = TIMEZERO
-                freq = 0
-                for line in history:
-                    timeStr, part, freqStr = line.partition(':')
-                    time = utcStrptime(timeStr.strip())
-                    freq = int(freqStr)
-                if x < time: x = time
-                if frequency != freq:
-                    print(x.strftime(TIMEFORMAT_FN), frequency, sep=":", file=history)
-                    self.dirty = True
-        except FileNotFoundError:
-            with open(f"{HISTORY_DIR}/actim{self.a.actimId:04d}.hist", "w") as history:
-                print(x.strftime(TIMEFORMAT_FN), frequency, sep=":", file=history)
-                self.dirty = True
+        if self.lastEvent is None:
+            self.lastEvent = self.readLastEvent()
+        time, freq = self.lastEvent
+        if x < time: x = time
+        if frequency != freq:
+            self.store.append(toEpoch(x), frequency)
+            self.lastEvent = (x, frequency)
+            self.dirty = True
         return self
+
+def drawOne(actimId, frequency):
+    written = ActimHistory(Actimetre(actimId, frequency=frequency)).drawGraph()
+    flushLog()
+    return written
+
+def drawInit(at):
+    # Pool workers start from a fresh interpreter: draw with the same NOW as the parent,
+    # and never write again log lines the parent still holds
+    LogLines.clear()
+    setNow(at)
+
+class GraphBatch:
+    # While started, drawGraphMaybe queues the graphs, then draw() renders them on a process pool,
+    # once the state locks are released
+    def __init__(self):
+        self.pending: dict[int, int] | None = None
+
+    def start(self):
+        self.pending = {}
+
+    def defer(self, actim):
+        if self.pending is None: return False
+        self.pending[actim.actimId] = actim.frequency
+        return True
+
+    def draw(self):
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        pending, self.pending = self.pending, None
+        if not pending: return 0
+        started = time.monotonic()
+        workers = min(GRAPH_WORKERS, len(pending))
+        if workers > 1:
+            # Forking this process would copy locks held by its other threads, start the workers clean
+            flushLog()
+            try:
+                with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver'),
+                                         initializer=drawInit, initargs=(NOW,)) as pool:
+                    futures = {actimId: pool.submit(drawOne, actimId, frequency) for actimId, frequency in pending.items()}
+                    images = []
+                    for actimId, future in futures.items():
+                        try:
+                            if future.result(): images.append(f'Image{actimId:04d}')
+                        except Exception as error:
+                            printLog(f'Graph for Actim{actimId:04d} failed: {error}')
+                feed.publish(images=images)
+            except OSError as error:
+                printLog(f'Graph pool failed ({error}), drawing serially')
+                workers = 1
+        if workers == 1:
+            for actimId, frequency in pending.items():
+                drawOne(actimId, frequency)
+        printLog(f'Drew {len(pending)} graphs in {time.monotonic() - started:.2f}s with {workers} workers')
+        return len(pending)
+
+Graphs = GraphBatch()
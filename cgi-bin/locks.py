@@ -0,0 +1,59 @@
+### Locks for concurrent requests in the resident process
+
+import threading
+from contextlib import contextmanager
+
+class SharedLock:
+    # Many holders in shared mode, or a single one in exclusive mode
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writer = False
+        self.waiting = 0
+
+    @contextmanager
+    def shared(self):
+        with self.condition:
+            while self.writer or self.waiting > 0:
+                self.condition.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                if self.readers == 0:
+                    self.condition.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        with self.condition:
+            self.waiting += 1
+            while self.writer or self.readers > 0:
+                self.condition.wait()
+            self.waiting -= 1
+            self.writer = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writer = False
+                self.condition.notify_all()
+
+class EntityLocks:
+    # One re-entrant lock per Actiserver, Actimetre or Project record.
+    # Take them in that order: server, then actim, then project.
+    def __init__(self):
+        self.locks: dict[tuple[str, int], threading.RLock] = {}
+        self.guard = threading.Lock()
+
+    def __call__(self, kind: str, entityId: int) -> threading.RLock:
+        with self.guard:
+            lock = self.locks.get((kind, entityId))
+            if lock is None:
+                lock = self.locks[(kind, entityId)] = threading.RLock()
+            return lock
+
+# Shared by requests that only touch their own records, exclusive for the others
+StateLock = SharedLock()
+Locks = EntityLocks()
@@ -0,0 +1,149 @@
+### Mail spool: requests queue the alerts, acticentral.py send-mail delivers them
+
+import time, threading
+from const import *
+
+def recipients(recipient):
+    # The project email, or every administrator when there is none
+    if recipient != "":
+        return [recipient]
+    try:
+        with open(ADMINISTRATORS, "r") as admins:
+            return [email.strip() for email in admins if email.strip() != ""]
+    except OSError:
+        return [ADMIN_EMAIL]
+
+def mailContent(subject, text, triggered=None):
+    if triggered is None: triggered = NOW
+    return f"""\
+Subject:{subject}
+This alert triggered at {triggered.strftime(TIMEFORMAT_ALERT)}
+
+{text}
+
+-----------------------------------------------
+For more information, please visit actimetre.fr
+.
+"""
+
+def spool(data, suffix):
+    # Renamed into place so the worker never sees half of it, None if the spool can't take it
+    name = f'{time.time_ns()}-{os.getpid()}-{threading.get_ident()}'
+    try:
+        os.makedirs(MAIL_SPOOL, exist_ok=True)
+        with open(f'{MAIL_SPOOL}/{name}.tmp', "w") as spoolFile:
+            json.dump(data, spoolFile)
+        os.replace(f'{MAIL_SPOOL}/{name}.tmp', f'{MAIL_SPOOL}/{name}{suffix}')
+    except OSError as error:
+        printLog(f'Spool {name}{suffix} failed: {error}')
+        try:
+            os.remove(f'{MAIL_SPOOL}/{name}.tmp')
+        except OSError:
+            pass
+        return None
+    return name
+
+def enqueue(recipient, content):
+    name = spool({'recipient': recipient, 'content': content, 'attempts': 0, 'next': 0}, '.mail')
+    if name is None:
+        printLog(f'Email to "{recipient}" not queued')
+        return False
+    printLog(f'Email to "{recipient}" queued as {name}')
+    return True
+
+def queueAlert(recipient, level, subject, text, context):
+    name = spool({'recipient': recipient, 'level': level, 'subject': subject, 'text': text,
+                  'context': context, 'time': time.time(), 'triggered': NOW.timestamp()}, '.alert')
+    if name is None:
+        printLog(f'Alert "{subject}" for "{recipient}" not queued')
+        return
+    printLog(f'Alert "{subject}" for "{recipient}" queued as {name}', LOG_DEBUG)
+
+def digestContent(alerts):
+    # The alerts by subject, with the context they share written once
+    subjects = {}
+    for alert in alerts:
+        subjects.setdefault(alert['subject'], []).append(alert)
+    text = ""
+    for subject, sameSubject in subjects.items():
+        if len(subjects) > 1:
+            text += f'=== {subject}\n\n'
+        for alert in sameSubject:
+            text += alert['text'] + '\n'
+        contexts = []
+        for alert in sameSubject:
+            if alert['context'] != "" and alert['context'] not in contexts:
+                contexts.append(alert['context'])
+        for context in contexts:
+            text += context + '\n'
+    if len(subjects) == 1:
+        subject = alerts[0]['subject']
+        if len(alerts) > 1: subject += f' ({len(alerts)} alerts)'
+    else:
+        subject = f'{len(alerts)} alerts, level {alerts[0]["level"]}'
+    return mailContent(subject, text.rstrip() + '\n',
+                       datetime.fromtimestamp(alerts[0]['triggered'], tz=timezone.utc))
+
+def digest():
+    # One mail per recipient and level, once the oldest of its alerts has waited ALERT_WINDOW
+    groups = {}
+    for name in sorted(os.listdir(MAIL_SPOOL)):
+        if not name.endswith('.alert'): continue
+        try:
+            with open(f'{MAIL_SPOOL}/{name}', "r") as spoolFile:
+                alert = json.load(spoolFile)
+        except (OSError, json.JSONDecodeError):
+            continue
+        groups.setdefault((alert['recipient'], alert['level']), []).append((name, alert))
+    for (recipient, level), alerts in groups.items():
+        if alerts[0][1]['time'] + ALERT_WINDOW > time.time(): continue
+        # Keep the alerts for the next run if the digest can't be queued
+        if not enqueue(recipient, digestContent([alert for name, alert in alerts])): continue
+        printLog(f'Digest of {len(alerts)} alerts, level {level}, for "{recipient}"')
+        for name, alert in alerts:
+            os.remove(f'{MAIL_SPOOL}/{name}')
+
+def sendmail(recipient, content):
+    try:
+        result = subprocess.run([SENDMAIL, "-F", "Acticentral", recipient], input=content, text=True,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=MAIL_TIMEOUT)
+    except (OSError, subprocess.TimeoutExpired) as error:
+        return False, str(error)
+    return result.returncode == 0, f'{result.returncode}: {result.stdout.strip()}'
+
+def deliver():
+    os.makedirs(MAIL_SPOOL, exist_ok=True)
+    lock = open(f'{MAIL_SPOOL}/.lock', "w")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        printLog("Mail spool busy")
+        return
+    digest()
+    for name in sorted(os.listdir(MAIL_SPOOL)):
+        if not name.endswith('.mail'): continue
+        filename = f'{MAIL_SPOOL}/{name}'
+        try:
+            with open(filename, "r") as spoolFile:
+                mail = json.load(spoolFile)
+        except (OSError, json.JSONDecodeError):
+            continue
+        if mail['next'] > time.time(): continue
+
+        sent, output = sendmail(mail['recipient'], mail['content'])
+        mail['attempts'] += 1
+        if sent:
+            printLog(f'Email sent to "{mail["recipient"]}", sendmail returns {output}')
+            os.remove(filename)
+        elif mail['attempts'] >= MAIL_RETRIES:
+            printLog(f'Email to "{mail["recipient"]}" failed {mail["attempts"]} times, giving up: {output}')
+            os.makedirs(f'{MAIL_SPOOL}/failed', exist_ok=True)
+            os.replace(filename, f'{MAIL_SPOOL}/failed/{name}')
+        else:
+            delay = MAIL_BACKOFF * 2 ** (mail['attempts'] - 1)
+            printLog(f'Email to "{mail["recipient"]}" failed, retry in {delay}s: {output}')
+            mail['next'] = time.time() + delay
+            with open(f'{filename}.tmp', "w") as spoolFile:
+                json.dump(mail, spoolFile)
+            os.replace(f'{filename}.tmp', filename)
+    lock.close()
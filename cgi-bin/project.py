@@ -1,5 +1,8 @@
 import sys
 from const import *
+from locks import Locks
+from storage import openStore, ChangeLog, LazyCollection
+import feed
 import actimetre, actiserver
 
 class Project:
@@ -49,6 +52,7 @@ class Project:
     def addActim(self, actimId: int):
         if actimId not in self.actimetreList:
             self.actimetreList.add(actimId)
+            Projects.actimToProject[actimId] = self.projectId
             self.stale = True
             printLog(f'Added Actim{actimId:04d} to Project{self.projectId:02d}')
             return True
@@ -57,6 +61,8 @@ class Project:
     def removeActim(self, actimId: int):
         if actimId in self.actimetreList:
             self.actimetreList.remove(actimId)
+            if Projects.actimToProject.get(actimId) == self.projectId:
+                del Projects.actimToProject[actimId]
             self.dirty = True
             return True
         else: return False
@@ -71,30 +77,18 @@ class Project:
         allImages = []
         for actimId in sorted(self.actimetreList):
             projectActims += f'<tr id="Actim{actimId:04d}"></tr>\n'
-            allPages.append('{' +
-                           f'id: "Actim{actimId:04d}", ' +
-                            f'ref: "/actimetre/actim{actimId:04d}.html", ' +
-                            f'date: "{JS_TIMEZERO}", ' +
-                            'html: ""}')
+            allPages.append(f'"Actim{actimId:04d}"')
             if Actimetres.hasGraph(actimId):
-                allImages.append('{' +
-                            f'id: "Image{actimId:04d}", ' +
-                            f'ref: "/images/actim{actimId:04d}.svg", ' +
-                            f'date: "{JS_TIMEZERO}", ' +
-                            'up: false}')
+                allImages.append(f'"Image{actimId:04d}"')
 
         projectServers = ""
         for serverId in sorted(self.serverList):
             projectServers += f'<tr id="Actis{serverId:03d}"></tr>\n'
-            allPages.append('{' +
-                            f'id: "Actis{serverId:03d}", ' +
-                            f'ref: "/actiserver/server{serverId:03d}.html", ' +
-                            f'date: "{JS_TIMEZERO}", ' +
-                            'html: ""}')
+            allPages.append(f'"Actis{serverId:03d}"')
 
         printLog(f'Write HTML Project{self.projectId:02d} = ' +
                  ' '.join(map(lambda a: f'Actim{a:04d}', self.actimetreList)) + ', ' +
-                 ' '.join(map(lambda s: f'Actis{s:03d}', self.serverList)))
+                 ' '.join(map(lambda s: f'Actis{s:03d}', self.serverList)), LOG_DEBUG)
 
         projectOwner = f"<h3>Project Owner: {self.owner}</h3>"
         projectEmail = f"<h3>Email: {self.email}</h3>"
@@ -113,6 +107,7 @@ class Project:
                          "{date}"          : jsDateString(now()),
                          "{document}"      : f'/project{self.projectId:02d}.html',
                          })
+        feed.publish(documents=[f"{HTML_ROOT}/project{self.projectId:02d}.html"])
 
     def htmlWriteFree(self):
         from actimetre import Actimetres
@@ -122,9 +117,7 @@ class Project:
         livePages = []
         for actimId in sorted(self.actimetreList):
             inline = f'<tr id="Actim{actimId:04d}"></tr>\n'
-            index = ('{' + f'id: "Actim{actimId:04d}", ' +
-                     f'ref: "/actimetre/actim{actimId:04d}.html", ' +
-                     f'date: "{JS_TIMEZERO}", ' + 'html: ""}')
+            index = f'"Actim{actimId:04d}"'
             if Actimetres.isAlive(actimId):
                 alive += inline
                 livePages.append(index)
@@ -149,6 +142,7 @@ class Project:
                              "{allpages}"   : ',\n'.join(livePages),
                              "{date}"       : jsDateString(now()),
                          })
+        feed.publish(documents=[ACTIMS0_HTML, ACTIMS_UN_HTML])
 
     def html(self):
         Actimetres = actimetre.Actimetres
@@ -171,23 +165,30 @@ class Project:
 
     def save(self):
         if self.stale:
-            printLog(f'Project{self.projectId:02d} is stale')
+            printLog(f'Project{self.projectId:02d} is stale', LOG_DEBUG)
             self.htmlWrite()
             self.dirty = True
         if self.dirty:
-            printLog(f'Project{self.projectId:02d} is dirty')
+            printLog(f'Project{self.projectId:02d} is dirty', LOG_DEBUG)
             if self.projectId == 0:
                 printLog('Write free Actimetres list')
                 self.htmlWriteFree()
             else:
-                with open(f'{PROJECT_DIR}/project{self.projectId:02d}.html', 'w') as html:
-                    print(self.html(), file=html)
-        return self.dirty
+                fragment = self.html()
+                if writeIfChanged(f'{PROJECT_DIR}/project{self.projectId:02d}.html', fragment + '\n'):
+                    feed.publish(pages={f'Project{self.projectId:02d}': fragment})
+            self.stale = False
+            self.dirty = False
+            return True
+        return False
+
+class ProjectsClass(LazyCollection):
+    lazyAttributes = ('projects', 'actimToProject', 'saved')
 
-class ProjectsClass:
     def __init__(self):
-        self.projects: dict[int, Project] = {}
         self.fileTime = TIMEZERO
+        self.store = openStore(PROJECTS)
+        self.changes = ChangeLog(PROJECTS_CHANGES)
         self.dirty = False
 
     def __str__(self):
@@ -203,47 +204,69 @@ class ProjectsClass:
         return item in self.projects
 
     def init(self):
-        self.projects = {int(projectId):Project().fromD(d) for projectId, d in loadData(PROJECTS).items()}
+        self.projects: dict[int, Project] = \
+            {int(projectId):Project().fromD(d) for projectId, d in self.store.load().items()}
         if self.projects.get(0) is None:
             printLog(f'Missing Project00, created')
             self.projects[0] = Project(0, "Not assigned", "No owner")
             self.dirty = True
-        self.fileTime = datetime.fromtimestamp(os.stat(PROJECTS).st_mtime, tz=timezone.utc)
-        if fileOlderThan(ACTIMS0_HTML, 3600) or fileOlderThan(ACTIMS_UN_HTML, 3600):
-            self.projects[0].dirty = True
-        Actimetres = actimetre.Actimetres
+        self.fileTime = self.store.modified()
+        self.saved: dict[str, int] = self.mapping()
+        # Orphans wait for reconcile() in the next maintenance run
+        self.index()
         Actiservers = actiserver.Actiservers
+        for project in self.projects.values():
+            for actimId in project.actimetreList:
+                serverId = Actiservers.getServerId(actimId)
+                if serverId != 0: project.serverList.add(serverId)
 
-        allProjectsActimSet = set()
+    def index(self):
+        self.actimToProject: dict[int, int] = {}
         for project in self.projects.values():
             actimetreSet = project.actimetreList.copy()
             for actimId in actimetreSet:
-                if actimId in allProjectsActimSet:
+                if actimId in self.actimToProject:
                     printLog(f'Actim{actimId:04d}[{project.projectId}] in duplicate, removed')
                     project.actimetreList.remove(actimId)
                     project.dirty = True
                     self.dirty = True
                 else:
-                    allProjectsActimSet.add(actimId)
-        allActimSet = Actimetres.allActimList()
-        diff = allActimSet - allProjectsActimSet
+                    self.actimToProject[actimId] = project.projectId
+
+    def reconcile(self):
+        allActimSet = actimetre.Actimetres.allActimList()
+        diff = allActimSet - self.actimToProject.keys()
         project0 = self.projects[0]
         for actimId in diff:
             printLog(f'Orphaned Actim{actimId:04d} taken as free')
             project0.actimetreList.add(actimId)
+            self.actimToProject[actimId] = 0
             project0.stale = True
             self.dirty = True
 
+    def checkIndex(self):
+        consistent = True
+        listed = {actimId: project.projectId
+                  for project in self.projects.values() for actimId in project.actimetreList}
+        for actimId, projectId in listed.items():
+            if self.actimToProject.get(actimId) != projectId:
+                printLog(f'Index has Actim{actimId:04d} in Project{self.actimToProject.get(actimId, 0):02d}, ' +
+                         f'listed in Project{projectId:02d}')
+                consistent = False
+        for actimId in self.actimToProject.keys() - listed.keys():
+            printLog(f'Index has Actim{actimId:04d} in Project{self.actimToProject[actimId]:02d}, not listed')
+            consistent = False
+        return consistent
+
+    def checkStale(self):
+        if fileOlderThan(ACTIMS0_HTML, 3600) or fileOlderThan(ACTIMS_UN_HTML, 3600):
+            self.projects[0].dirty = True
         for project in self.projects.values():
             if project.projectId != 0:
                 if fileOlderThan(f'{HTML_ROOT}/project{project.projectId:02d}.html', 3600) :
                     project.stale = True
                 if fileOlderThan(f'{PROJECT_DIR}/project{project.projectId:02d}.html', 3600) :
                     project.dirty = True
-        for project in self.projects.values():
-            for actimId in project.actimetreList:
-                serverId = Actiservers.getServerId(actimId)
-                if serverId != 0: project.serverList.add(serverId)
 
     def dump(self):
         string = ""
@@ -252,6 +275,24 @@ class ProjectsClass:
                 string += f'{projectId}:' + ','.join([str(a) for a in list(p.actimetreList)]) + '\n'
         return string
 
+    def mapping(self):
+        # What dump() lists, as Actimetre to Project
+        return {str(actimId): projectId
+                for projectId, p in self.projects.items() for actimId in p.actimetreList}
+
+    def dumpFor(self, actimIds):
+        # dump() restricted to these Actimetres
+        byProject: dict[int, list[int]] = {}
+        for actimId in sorted(actimIds):
+            projectId = self.actimToProject.get(actimId)
+            if projectId is not None:
+                byProject.setdefault(projectId, []).append(actimId)
+        return ''.join(f'{projectId}:' + ','.join(str(a) for a in actimList) + '\n'
+                       for projectId, actimList in sorted(byProject.items()))
+
+    def since(self, version):
+        return json.dumps(self.changes.since(version, self.saved))
+
     def listIds(self):
         return sorted(self.projects.keys())
 
@@ -270,9 +311,7 @@ class ProjectsClass:
         return self.projects[projectId].email
 
     def getProjectId(self, actimId):
-        for project in self.projects.values():
-            if actimId in project.actimetreList: return project.projectId
-        return 0
+        return self.actimToProject.get(actimId, 0)
 
     def new(self, title, owner, email) -> int:
         projectId = 1
@@ -293,31 +332,33 @@ class ProjectsClass:
         return self[projectId]
 
     def moveActim(self, actimId, projectId):
-        for p in self.projects.values():
-            if actimId in p.actimetreList:
-                printLog(f'Removed Actim{actimId:04d} from Project{p.projectId:02d}')
-                p.actimetreList.remove(actimId)
-                p.stale = True
-        if projectId in self.projects.keys():
-            p = self.projects[projectId]
-        else:
-            p = Project(projectId)
-        if p.addActim(actimId):
+        if projectId not in self.projects.keys():
+            printLog(f"Can't move Actim{actimId:04d} to missing Project{projectId:02d}")
+            return
+        oldProjectId = self.actimToProject.get(actimId)
+        if oldProjectId is not None and oldProjectId != projectId:
+            p = self.projects[oldProjectId]
+            printLog(f'Removed Actim{actimId:04d} from Project{p.projectId:02d}')
+            p.removeActim(actimId)
+            p.stale = True
+        if self.projects[projectId].addActim(actimId):
             self.dirty = True
 
     def makeDirty(self, actimId):
-        for project in self.projects.values():
-            if actimId in project.actimetreList:
-                project.dirty = True
+        projectId = self.actimToProject.get(actimId)
+        if projectId is not None:
+            with Locks('project', projectId):
+                self.projects[projectId].dirty = True
 
     def makeStaleMaybe(self):
         Actiservers = actiserver.Actiservers
         for project in self.projects.values():
-            for actimId in project.actimetreList:
-                s = Actiservers.getServerId(actimId)
-                if s != 0 and not s in project.serverList:
-                    project.serverList.add(s)
-                    project.stale = True
+            with Locks('project', project.projectId):
+                for actimId in project.actimetreList:
+                    s = Actiservers.getServerId(actimId)
+                    if s != 0 and not s in project.serverList:
+                        project.serverList.add(s)
+                        project.stale = True
 
     def htmlChoice(self, projectId=0):
         htmlString = ""
@@ -418,6 +459,8 @@ class ProjectsClass:
             if projectId in self.projects:
                 if len(self.projects[projectId].actimetreList) == 0:
                     del self.projects[projectId]
+                    for actimId, ownerId in list(self.actimToProject.items()):
+                        if ownerId == projectId: del self.actimToProject[actimId]
                     self.dirty = True
                     print(f"Location:\\{INDEX_NAME}\n\n")
                 else:
@@ -429,20 +472,53 @@ class ProjectsClass:
             print("Status: 205\n\n")
 
     def actimIsStale(self, actimId):
-        for p in self.projects.values():
-            if actimId in p.actimetreList:
-                p.stale = True
+        projectId = self.actimToProject.get(actimId)
+        if projectId is not None:
+            self.projects[projectId].stale = True
 
     def needUpdate(self, serverTime):
         return self.fileTime > serverTime
 
+    def recordSave(self):
+        current = self.mapping()
+        self.changes.record(self.saved, current)
+        self.saved = current
+        writeDump(PROJECTS_DUMP, self.dump())
+
+    def deferSave(self, pending):
+        # Save the data only, and leave the HTML to the next save()
+        if not self.loaded(): return
+        for p in self.projects.values():
+            if p.stale:
+                pending['projectStale'].add(p.projectId)
+            elif p.dirty:
+                pending['project'].add(p.projectId)
+            p.stale = p.dirty = False
+        if self.dirty:
+            self.store.replace({int(p.projectId):p.toD() for p in self.projects.values()})
+            self.recordSave()
+            self.fileTime = self.store.modified()
+            pending['page'].add('projects')
+            self.dirty = False
+
+    def restore(self, pending):
+        for projectId in pending['project'] & self.projects.keys():
+            self.projects[projectId].dirty = True
+        for projectId in pending['projectStale'] & self.projects.keys():
+            self.projects[projectId].stale = True
+        if 'projects' in pending['page']:
+            self.dirty = True
+
     def save(self):
+        if not self.loaded(): return
         for p in self.projects.values():
             p.save()
         if self.dirty:
-            dumpData(PROJECTS, {int(p.projectId):p.toD() for p in self.projects.values()})
-            self.fileTime = datetime.fromtimestamp(os.stat(PROJECTS).st_mtime, tz=timezone.utc)
+            self.store.replace({int(p.projectId):p.toD() for p in self.projects.values()})
+            self.recordSave()
+            self.fileTime = self.store.modified()
             self.projects[0].htmlWriteFree()
+            self.dirty = False
 
 Projects = ProjectsClass()
 def initProjects() -> ProjectsClass:
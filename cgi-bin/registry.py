@@ -1,16 +1,28 @@
-import shutil
+import heapq
 from const import *
+from storage import openStore, ChangeLog
 
 class RegistryClass:
     def __init__(self):
-        self.macToId: dict[str, int] = {}
-        with open(REGISTRY, "r") as registry:
-            try:
-                self.macToId = json.load(registry)
-            except json.JSONDecodeError:
-                pass
-        self.fileTime = datetime.fromtimestamp(os.stat(REGISTRY).st_mtime, tz=timezone.utc)
+        self.store = openStore(REGISTRY)
+        self.macToId: dict[str, int] = self.store.load()
+        self.fileTime = self.store.modified()
+        self.saved = dict(self.macToId)
+        self.changes = ChangeLog(REGISTRY_CHANGES)
         self.dirty = False
+        self.rebuild()
+
+    def rebuild(self):
+        # Reverse maps, and the holes below the highest ID kept as a heap for allocation
+        self.idToMac: dict[int, str] = {}
+        self.idToMacs: dict[int, set[str]] = {}
+        for mac, actimId in self.macToId.items():
+            if actimId in self.idToMac:
+                printLog(f"Actim{actimId:04d} registered for both {self.idToMac[actimId]} and {mac}")
+            self.idToMac[actimId] = mac
+            self.idToMacs.setdefault(actimId, set()).add(mac)
+        self.highestId = max(self.idToMac.keys(), default=0)
+        self.freeIds = [actimId for actimId in range(1, self.highestId) if actimId not in self.idToMac]
 
     def getId(self, mac):
         if mac in self.macToId:
@@ -18,40 +30,52 @@ class RegistryClass:
             printLog(f"Found known Actim{actimId:04d} for {mac}")
             return actimId
         else:
-            actimList = list(self.macToId.values())
-            actimList.sort()
-            actimId = len(actimList) + 1
-            for newId in range(1, len(actimList) + 1):
-                if not newId in actimList:
-                    actimId = newId
-                    break
+            if len(self.freeIds) > 0:
+                actimId = heapq.heappop(self.freeIds)
+            else:
+                self.highestId += 1
+                actimId = self.highestId
             self.macToId[mac] = actimId
+            self.idToMac[actimId] = mac
+            self.idToMacs.setdefault(actimId, set()).add(mac)
             printLog(f"Allocated new Actim{actimId:04d} for {mac}")
             self.dirty = True
             return actimId
 
     def deleteId(self, actimId):
-        for mac, macId in self.macToId.items():
-            if macId == actimId:
-                del self.macToId[mac]
-                self.dirty = True
+        mac = self.idToMac.pop(actimId, None)
+        if mac is not None:
+            del self.macToId[mac]
+            self.dirty = True
+            # Free the ID only once no other MAC is registered for it
+            others = self.idToMacs[actimId]
+            others.discard(mac)
+            if len(others) > 0:
+                self.idToMac[actimId] = min(others)
+            else:
+                del self.idToMacs[actimId]
+                heapq.heappush(self.freeIds, actimId)
 
     def save(self):
         if self.dirty:
-            registryBackup = REGISTRY_BACKUP + datetime.now().strftime(TIMEFORMAT_FN)
-            try:
-                shutil.copyfile(REGISTRY, registryBackup)
-            except OSError:
-                pass
-
-            with open(REGISTRY, "w") as registry:
-                json.dump(self.macToId, registry)
+            self.store.backup(REGISTRY_BACKUP + datetime.now().strftime(TIMEFORMAT_FN))
+            self.store.replace(self.macToId)
             printLog("Saved Registry " + str(self.macToId))
-            self.fileTime = datetime.fromtimestamp(os.stat(REGISTRY).st_mtime, tz=timezone.utc)
+            self.changes.record(self.saved, self.macToId)
+            self.saved = dict(self.macToId)
+            writeDump(REGISTRY_DUMP, self.dump())
+            self.fileTime = self.store.modified()
+            self.dirty = False
 
     def dump(self):
         return json.dumps(self.macToId)
 
+    def dumpFor(self, actimIds):
+        return json.dumps({self.idToMac[actimId]: actimId for actimId in sorted(actimIds) if actimId in self.idToMac})
+
+    def since(self, version):
+        return json.dumps(self.changes.since(version, self.saved))
+
     def needUpdate(self, serverTime):
         return self.fileTime > serverTime
 
@@ -0,0 +1,132 @@
+### Resident mode: keep the fleet state in memory between requests
+
+import io, socket, threading, http.client, traceback, urllib.parse
+from http import HTTPStatus
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+from const import *
+import feed
+
+def isRunning():
+    try:
+        socket.create_connection(RESIDENT_ADDRESS, timeout=1).close()
+    except OSError:
+        return False
+    return True
+
+def forward(queryString, client):
+    # Relay a CGI request to the resident process, returns False if there is none
+    connection = http.client.HTTPConnection(*RESIDENT_ADDRESS, timeout=RESIDENT_TIMEOUT)
+    try:
+        connection.connect()
+    except OSError:
+        return False
+
+    # The web server may keep stdin open past the body
+    body = sys.stdin.buffer.read(int(os.environ.get('CONTENT_LENGTH') or 0))
+    headers = {name[5:].replace('_', '-').title(): value
+               for name, value in os.environ.items() if name.startswith('HTTP_')}
+    headers['X-Forwarded-For'] = client
+    if 'CONTENT_TYPE' in os.environ:
+        headers['Content-Type'] = os.environ['CONTENT_TYPE']
+    connection.request('POST' if len(body) > 0 else 'GET',
+                       f'{RESIDENT_PATH}?{queryString}', body=body, headers=headers)
+    response = connection.getresponse()
+
+    output = sys.stdout.buffer
+    output.write(f'Status: {response.status} {response.reason}\n'.encode())
+    for name, value in response.getheaders():
+        if name.lower() not in ('date', 'server', 'connection', 'content-length', 'transfer-encoding'):
+            output.write(f'{name}: {value}\n'.encode())
+    output.write(b'\n')
+    while True:
+        chunk = response.read1()
+        if len(chunk) == 0: break
+        output.write(chunk)
+        output.flush()
+    connection.close()
+    return True
+
+def cgiResponse(output: bytes):
+    # Split what a CGI handler printed into WSGI status, headers and body
+    if output == b"":
+        return '204 No Content', [], b''
+    head, separator, body = output.partition(b'\n\n')
+    status = 0
+    headers = []
+    for line in head.decode().splitlines():
+        name, colon, value = line.partition(':')
+        if colon == '' or ' ' in name.strip(): continue
+        if name.strip().lower() == 'status':
+            status = int(value.split()[0])
+        else:
+            headers.append((name.strip(), value.strip()))
+    if status == 0:
+        if any(name.lower() == 'location' for name, value in headers): status = 302
+        else: status = 200
+    return f'{status} {HTTPStatus(status).phrase}', headers, body
+
+class ThreadStream(threading.local):
+    # Stands for sys.stdin/sys.stdout, so that each request thread prints to its own buffer
+    def __init__(self, default):
+        self.stream = default
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+class ResidentServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+    def __init__(self, handle, flush, tick):
+        super().__init__(RESIDENT_ADDRESS, QuietHandler)
+        self.set_app(self.application)
+        sys.stdin = ThreadStream(sys.__stdin__)
+        sys.stdout = ThreadStream(sys.__stdout__)
+        self.handle = handle
+        self.flush = flush
+        self.tick = tick
+        self.lastFlush = now()
+        self.lastTick = now()
+
+    def application(self, environ, start_response):
+        if urllib.parse.parse_qs(environ.get('QUERY_STRING', '')).get('action') == ['events']:
+            start_response('200 OK', [('Content-Type', 'text/event-stream'), ('Cache-Control', 'no-store')])
+            return feed.stream()
+        setNow()
+        client = environ.get('HTTP_X_FORWARDED_FOR', environ.get('REMOTE_ADDR', ''))
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        sys.stdin.stream = io.TextIOWrapper(io.BytesIO(environ['wsgi.input'].read(length)))
+        sys.stdout.stream = output = io.TextIOWrapper(io.BytesIO(), encoding='utf-8', newline='\n')
+        try:
+            self.handle(environ.get('QUERY_STRING', ''), client, environ)
+        except Exception:
+            printLog(traceback.format_exc())
+            start_response('500 Internal Server Error', [])
+            return [b'']
+        finally:
+            sys.stdin.stream = sys.__stdin__
+            sys.stdout.stream = sys.__stdout__
+            flushLog()
+        output.flush()
+        status, headers, body = cgiResponse(output.buffer.getvalue())
+        start_response(status, headers)
+        return [body]
+
+    def service_actions(self):
+        try:
+            if now() - self.lastTick > RESIDENT_TICK:
+                self.lastTick = self.lastFlush = now()
+                setNow()
+                self.tick()
+            elif now() - self.lastFlush > RESIDENT_FLUSH:
+                self.lastFlush = now()
+                setNow()
+                self.flush()
+        except Exception:
+            printLog(traceback.format_exc())
+        flushLog()
@@ -0,0 +1,149 @@
+### Storage for the registry, Actimetres, Actiservers and Projects
+
+import shutil, sqlite3, threading
+from const import *
+
+class JsonStore:
+    # A .data snapshot, plus a journal of the records changed since
+    def __init__(self, filename):
+        self.filename = filename
+
+    def load(self) -> dict:
+        return loadData(self.filename)
+
+    def put(self, changes: dict, snapshot):
+        journalData(self.filename, changes, snapshot)
+
+    def replace(self, data: dict):
+        dumpData(self.filename, data)
+
+    def compact(self, snapshot):
+        compactData(self.filename, snapshot)
+
+    def modified(self) -> datetime:
+        times = []
+        for filename in (self.filename, journalFile(self.filename)):
+            try:
+                times.append(os.stat(filename).st_mtime)
+            except OSError:
+                pass
+        return datetime.fromtimestamp(max(times), tz=timezone.utc) if len(times) > 0 else TIMEZERO
+
+    def backup(self, filename):
+        try:
+            shutil.copyfile(self.filename, filename)
+        except OSError:
+            pass
+
+class SqliteStore:
+    # One table of JSON records per store in DATABASE, in WAL mode so readers don't wait for writers
+    connections = threading.local()
+
+    def __init__(self, filename):
+        self.table = os.path.splitext(os.path.basename(filename))[0]
+        with self.connect() as db:
+            db.execute(f'CREATE TABLE IF NOT EXISTS {self.table} (id TEXT PRIMARY KEY, data TEXT NOT NULL)')
+            db.execute('CREATE TABLE IF NOT EXISTS modified (store TEXT PRIMARY KEY, time REAL NOT NULL)')
+
+    def connect(self) -> sqlite3.Connection:
+        db = getattr(self.connections, 'db', None)
+        if db is None:
+            db = self.connections.db = sqlite3.connect(DATABASE, timeout=RESIDENT_TIMEOUT)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def touch(self, db):
+        db.execute('INSERT OR REPLACE INTO modified VALUES (?, ?)', (self.table, now().timestamp()))
+
+    def load(self) -> dict:
+        return {itemId: json.loads(data)
+                for itemId, data in self.connect().execute(f'SELECT id, data FROM {self.table}')}
+
+    def put(self, changes: dict, snapshot=None):
+        printLog(f"[PUT {self.table}] {' '.join(str(itemId) for itemId in changes.keys())}", LOG_DEBUG)
+        with self.connect() as db:
+            db.executemany(f'INSERT OR REPLACE INTO {self.table} VALUES (?, ?)',
+                           [(str(itemId), json.dumps(data)) for itemId, data in changes.items() if data is not None])
+            db.executemany(f'DELETE FROM {self.table} WHERE id = ?',
+                           [(str(itemId),) for itemId, data in changes.items() if data is None])
+            self.touch(db)
+
+    def replace(self, data: dict):
+        printLog(f"[REPLACE {self.table}]")
+        with self.connect() as db:
+            db.execute(f'DELETE FROM {self.table}')
+            db.executemany(f'INSERT INTO {self.table} VALUES (?, ?)',
+                           [(str(itemId), json.dumps(item)) for itemId, item in data.items()])
+            self.touch(db)
+
+    def compact(self, snapshot):
+        pass
+
+    def modified(self) -> datetime:
+        row = self.connect().execute('SELECT time FROM modified WHERE store = ?', (self.table,)).fetchone()
+        return TIMEZERO if row is None else datetime.fromtimestamp(row[0], tz=timezone.utc)
+
+    def backup(self, filename):
+        with open(filename, "w") as backup:
+            json.dump(self.load(), backup)
+
+class LazyCollection:
+    # Loads itself with init() on first use of its records, so that a request only reads what it touches
+    lazyAttributes: tuple[str, ...] = ()
+
+    def __getattr__(self, name):
+        if name in type(self).lazyAttributes:
+            self.init()
+            return vars(self)[name]
+        raise AttributeError(name)
+
+    def loaded(self):
+        return self.lazyAttributes[0] in vars(self)
+
+class ChangeLog:
+    # Numbered changes to a mapping, so that an Actiserver only fetches what changed since its copy
+    def __init__(self, filename):
+        self.filename = filename
+        log = loadData(filename) if os.path.isfile(filename) else {}
+        self.version: int = int(log.get('version', 0))
+        self.changes: list[dict] = log.get('changes', [])
+
+    def record(self, old: dict, new: dict):
+        changed = {key: value for key, value in new.items() if old.get(key) != value}
+        removed = [key for key in old.keys() if key not in new]
+        if len(changed) == 0 and len(removed) == 0: return
+        self.version += 1
+        self.changes = self.changes[-(CHANGES_KEEP - 1):] + \
+                       [{'version': self.version, 'set': changed, 'del': removed}]
+        dumpData(self.filename, {'version': self.version, 'changes': self.changes})
+
+    def since(self, version, current: dict):
+        # The changes after version, or all of current when the log doesn't reach back that far
+        if version > self.version or \
+                (version < self.version and (len(self.changes) == 0 or self.changes[0]['version'] > version + 1)):
+            return {'version': self.version, 'full': current}
+        changed = {}
+        removed = set()
+        for change in self.changes:
+            if change['version'] <= version: continue
+            for key, value in change['set'].items():
+                changed[key] = value
+                removed.discard(key)
+            for key in change['del']:
+                changed.pop(key, None)
+                removed.add(key)
+        return {'version': self.version, 'set': changed, 'del': sorted(removed)}
+
+def openStore(filename):
+    if STORAGE == "sqlite":
+        return SqliteStore(filename)
+    return JsonStore(filename)
+
+def migrateStores():
+    # Copy the .data files, with their journals, into DATABASE
+    for filename in (REGISTRY, ACTIMETRES, ACTISERVERS, PROJECTS):
+        data = loadData(filename)
+        SqliteStore(filename).replace(data)
+        printLog(f"Migrated {len(data)} records from {filename}")
+        print(f"Migrated {len(data)} records from {filename}")
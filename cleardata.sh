@@ -3,9 +3,11 @@
 cd /etc/actimetre
 
 echo > central.log
+rm -f central.log.*
 echo > acticentral.lock
 echo {} > actiservers.data
 echo {} > actimetres.data
+rm -f *.journal
 
 chmod 666 *.data *.log
 rm -f history/actim*.hist
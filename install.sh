@@ -1,14 +1,18 @@
 #!/usr/bin/bash
 
+systemctl stop acticentrald.service
 systemctl stop acticentral.timer
 systemctl stop acticentral-daily.timer
 systemctl stop acticentral-weekly.timer
+systemctl stop acticentral-mail.timer
 
 mkdir /etc/actimetre
 mkdir /etc/actimetre/history
 mkdir /etc/actimetre/daily
 mkdir /etc/actimetre/weekly
 mkdir /etc/actimetre/registry
+mkdir /etc/actimetre/mail
+mkdir /etc/actimetre/rendered
 mkdir /etc/matplotlib
 chmod 777 /etc/matplotlib
 mkdir /var/www/cgi-bin
@@ -37,7 +41,7 @@ echo > registry.data
 echo > projects.data
 chown -R www-data:www-data . *
 chmod 666 * history/*
-chmod 777 . *.sh history daily weekly registry
+chmod 777 . *.sh history daily weekly registry mail rendered
 
 systemctl daemon-reload
 systemctl enable acticentral.timer
@@ -46,6 +50,10 @@ systemctl enable acticentral-daily.timer
 systemctl start acticentral-daily.timer
 systemctl enable acticentral-weekly.timer
 systemctl start acticentral-weekly.timer
+systemctl enable acticentral-mail.timer
+systemctl start acticentral-mail.timer
+systemctl enable acticentrald.service
+systemctl start acticentrald.service
 
 echo "Entry point is /var/www/html/acticentral.html: make links as needed"
 echo "Edit /etc/actimetre/.secret for the secret key"
@@ -0,0 +1,12 @@
+#!/usr/bin/bash
+# Stand-in for sendmail: set SENDMAIL to this script and the mails land in $SENDMAIL_LOCAL
+# Exits with $SENDMAIL_FAIL when set, to exercise the retries
+
+if [ -n "$SENDMAIL_FAIL" ]; then
+    exit "$SENDMAIL_FAIL"
+fi
+{
+    echo "To: ${@: -1}"
+    cat
+    echo
+} >> "${SENDMAIL_LOCAL:-/tmp/acticentral-mail.txt}"
@@ -1,8 +1,10 @@
 #!/usr/bin/bash
 
+sudo systemctl stop acticentrald.service
 sudo systemctl stop acticentral.timer
 sudo systemctl stop acticentral-daily.timer
 sudo systemctl stop acticentral-weekly.timer
+sudo systemctl stop acticentral-mail.timer
 
 cp clear*.sh /etc/actimetre
 cp cgi-bin/acticentral.py /var/www/cgi-bin/acticentral.py
@@ -18,12 +20,13 @@ chmod 775 html/index.html cgi-bin/acticentral.py
 chmod 777 html html/images
 
 cd /etc/actimetre
+mkdir -p mail rendered
 echo > central.log
 echo > acticentral.lock
 rm -f acticentral.pid
 chown -R www-data:www-data . *
 chmod 666 * history/*
-chmod 777 . *.sh history
+chmod 777 . *.sh history mail rendered
 
 systemctl daemon-reload
 sudo systemctl enable acticentral.timer
@@ -32,3 +35,6 @@ systemctl enable acticentral-daily.timer
 systemctl start acticentral-daily.timer
 systemctl enable acticentral-weekly.timer
 systemctl start acticentral-weekly.timer
+systemctl enable acticentral-mail.timer
+systemctl start acticentral-mail.timer
+systemctl start acticentrald.service